@@ -7,36 +7,22 @@ import math
 
 
 
-def h5_postprocess(f):
+def h5_postprocess(f, chunk_size = 50000):
     w_min = 0.1
     w_max = 10.
     #fix weight normalizations: first clip outliers, normalize, clip remaining outliers, normalize
+    #done in streaming passes over chunks of events, so the full toy arrays never need to fit in memory
 
-
-    f['lund_weights'][:]  = np.clip(f['lund_weights'][:], 0., w_max)
-    f['lund_weights'][:] /= np.mean(f['lund_weights'][:])
-    f['lund_weights'][:]  = np.clip(f['lund_weights'][:], w_min, w_max)
-    f['lund_weights'][:] /= np.mean(f['lund_weights'][:])
+    normalize_weights_chunked(f['lund_weights'], w_min = w_min, w_max = w_max, chunk_size = chunk_size)
     print('weights_normed', f['lund_weights'][:10])
 
-    f['lund_weights_stat_var'][:]  = np.clip(f['lund_weights_stat_var'][:], 0., w_max)
-    f['lund_weights_stat_var'][:]  /= np.mean(f['lund_weights_stat_var'][:], axis = 0, keepdims=True)
-    f['lund_weights_stat_var'][:]  = np.clip(f['lund_weights_stat_var'][:], w_min, w_max)
-    f['lund_weights_stat_var'][:]  /= np.mean(f['lund_weights_stat_var'][:], axis = 0, keepdims=True)
-
-    f['lund_weights_pt_var'][:]  = np.clip(f['lund_weights_pt_var'][:], 0., w_max)
-    f['lund_weights_pt_var'][:]  /= np.mean(f['lund_weights_pt_var'][:], axis = 0, keepdims=True)
-    f['lund_weights_pt_var'][:]  = np.clip(f['lund_weights_pt_var'][:], w_min, w_max)
-    f['lund_weights_pt_var'][:]  /= np.mean(f['lund_weights_pt_var'][:], axis = 0, keepdims=True)
+    normalize_weights_chunked(f['lund_weights_stat_var'], w_min = w_min, w_max = w_max, chunk_size = chunk_size)
+    normalize_weights_chunked(f['lund_weights_pt_var'], w_min = w_min, w_max = w_max, chunk_size = chunk_size)
 
-    f['lund_weights_sys_var'][:]  = np.clip(f['lund_weights_sys_var'][:], 0., w_max)
-    f['lund_weights_sys_var'][:]  /= np.mean(f['lund_weights_sys_var'][:], axis = 0, keepdims=True)
-    f['lund_weights_sys_var'][:]  = np.clip(f['lund_weights_sys_var'][:], w_min, w_max)
-    f['lund_weights_sys_var'][:]  /= np.mean(f['lund_weights_sys_var'][:], axis = 0, keepdims=True)
     #make sys variations multiplicative factors relative to nom
-    f['lund_weights_sys_var'][:] /= np.expand_dims(f['lund_weights'][:], -1)
-    print('average sys mult fac.' , np.mean(f['lund_weights_sys_var'][:], axis = 0, keepdims=True))
-    print( 'average sys weight', np.mean(f['lund_weights_sys_var'][:] * f['lund_weights'][:].reshape(-1,1), axis = 0, keepdims = True))
+    normalize_weights_chunked(f['lund_weights_sys_var'], w_min = w_min, w_max = w_max, chunk_size = chunk_size, nom = f['lund_weights'])
+    print('average sys mult fac.' , dset_mean(f['lund_weights_sys_var'], chunk_size = chunk_size).reshape(1,-1))
+    print( 'average sys weight', dset_mean(f['lund_weights_sys_var'], chunk_size = chunk_size, scale = f['lund_weights']).reshape(1,-1))
 
     #f['lund_weights_sys_var'][:]  = np.clip(f['lund_weights_sys_var'][:], 0.1, 10.)
 
@@ -49,7 +35,7 @@ def h5_postprocess(f):
 
 
 
-def run():
+def run(options = None, postprocess = None):
 
     debug = False
     if(debug):
@@ -57,8 +43,9 @@ def run():
         tracemalloc.start()
 
 
-    parser = input_options()
-    options = parser.parse_args()
+    if(options is None):
+        parser = input_options()
+        options = parser.parse_args()
 
     print(options)
 
@@ -70,10 +57,12 @@ def run():
 
 
     
-    f_sig = h5py.File(options.fin, "a")
     if(options.fout != ""):
+        #input only read, so several jobs can run on the same file
+        f_sig = h5py.File(options.fin, "r")
         f_out = h5py.File(options.fout, "a")
     else:
+        f_sig = h5py.File(options.fin, "a")
         f_out = f_sig
 
     keys = [ "lund_weights", "lund_weights_stat_var", "lund_weights_pt_var", "lund_weights_sys_var", "lund_weights_matching_unc", "lund_weights_matching"]
@@ -123,12 +112,12 @@ def run():
     h_ratio = f_ratio.Get("ratio_nom")
     f_ratio.cd('pt_extrap')
     rdir = ROOT.gDirectory
-    LP_rw = LundReweighter(jetR = jetR, pt_extrap_dir = rdir, charge_only = options.charge_only)
+    LP_rw = LundReweighter(jetR = jetR, pt_extrap_dir = rdir, charge_only = options.charge_only, backend = options.backend)
 
     #Noise used to generated smeared ratio's based on stat unc
-    np.random.seed(123)
-    rand_noise = np.random.normal(size = (nToys, h_ratio.GetNbinsX(), h_ratio.GetNbinsY(), h_ratio.GetNbinsZ()))
-    pt_rand_noise = np.random.normal(size = (nToys, h_ratio.GetNbinsY(), h_ratio.GetNbinsZ(), 3))
+    #counter-based, so the toys are the same in every job regardless of job_idx / batch size
+    rand_noise = ToyNoise(nToys, (h_ratio.GetNbinsX(), h_ratio.GetNbinsY(), h_ratio.GetNbinsZ()), seed = 123, stream = 0)
+    pt_rand_noise = ToyNoise(nToys, (h_ratio.GetNbinsY(), h_ratio.GetNbinsZ(), 3), seed = 123, stream = 1)
     print('rand', rand_noise[0,0,0,:5])
 
     iters = int(math.ceil(float(nevts_batch)/batch_size))
@@ -136,98 +125,87 @@ def run():
 
     snapshots = []
 
-    for i in range(iters):
-        if(debug): 
-            snapshots.append(tracemalloc.take_snapshot())
-
-        sys.stdout.flush()
-        print("batch %i \n" %i)
-
-
-
-
+    sys_list = ["sys_tot_up", "sys_tot_down"]
+    if(not options.no_sys):
+        #sys_list = list(sys_weights_map.keys())
+        sys_ratios = [f_ratio.Get("ratio_" + sys_) for sys_ in sys_list]
+        #vary weights up/down for b-quark subjets by ratio of b-quark to light quark LP
+        b_light_ratio = f_ratio.Get("h_bl_ratio")
 
+    def read_batch(i):
+        #all the reads of a batch, done in a background thread while the previous batch is clustered
         start_idx = global_start_idx + i*batch_size
         stop_idx = global_start_idx + min(nevts_batch, (i+1)*batch_size)
-        print('start, stop', start_idx, stop_idx)
-
-        subjets1, splittings1, bad_match1,_ = d.get_matched_splittings(LP_rw, num_excjets = num_excjets, which_j = 1, min_evts = start_idx, max_evts = stop_idx)
-        subjets2, splittings2, bad_match2,_ = d.get_matched_splittings(LP_rw, num_excjets = num_excjets, which_j = 2, min_evts = start_idx, max_evts = stop_idx)
-
-
-
-        weights1, smeared_weights1, pt_smeared_weights1 = d.reweight_LP(LP_rw, h_ratio, num_excjets = num_excjets, norm = False,
-                min_evts = start_idx, max_evts = stop_idx,  prefix = "", rand_noise = rand_noise, pt_rand_noise = pt_rand_noise, subjets = subjets1, splittings = splittings1)
-
-        weights2, smeared_weights2, pt_smeared_weights2 = d.reweight_LP(LP_rw, h_ratio, num_excjets = num_excjets,  norm = False,
-                min_evts = start_idx, max_evts = stop_idx, prefix = "", rand_noise = rand_noise, pt_rand_noise = pt_rand_noise, subjets = subjets2, splittings = splittings2)
-
-        print(len(weights1))
-
-        is_lep = f_sig['event_info'][:,4][:max_evts]
-        lep_cut = (is_lep < 0.5)
-
-
-
-        weights = np.array(weights1) * np.array(weights2)
-        smeared_weights = np.array(smeared_weights1) * np.array(smeared_weights2)
-        pt_smeared_weights = np.array(pt_smeared_weights1) * np.array(pt_smeared_weights2)
-
-        #2 jets, so count each bad match as a 50% unc on the evt weight
-        bad_match1_val = np.array([0.5*bm for bm in bad_match1])
-        bad_match2_val = np.array([0.5*bm for bm in bad_match2])
-
-        bad_match = bad_match1_val + bad_match2_val
-
-
-
-
-
-        n_sys = 4
-        sys_variations = np.ones((len(weights), n_sys))
-        if(not options.no_sys):
-            #sys_list = list(sys_weights_map.keys())
-            sys_list = ["sys_tot_up", "sys_tot_down"]
-            for i,sys_ in enumerate(sys_list):
-                sys_ratio = f_ratio.Get("ratio_" + sys_)
-                sys_str = sys_ + "_"
-
-
-                sys_weights1 = d.reweight_LP(LP_rw, sys_ratio, num_excjets = num_excjets, prefix = "", norm = False,
-                        min_evts = start_idx, max_evts = stop_idx, sys_str = sys_str, subjets = subjets1, splittings = splittings1)
-
-                sys_weights2 = d.reweight_LP(LP_rw, sys_ratio, num_excjets = num_excjets, prefix = "",  norm = False,
-                        min_evts = start_idx, max_evts = stop_idx, sys_str = sys_str, subjets = subjets2, splittings = splittings2)
-
-
-                sys_variations[:,i] = np.array(sys_weights1) * np.array(sys_weights2)
-
-            #vary weights up/down for b-quark subjets by ratio of b-quark to light quark LP
-            b_light_ratio = f_ratio.Get("h_bl_ratio")
-            bquark_rw1 = d.reweight_LP(LP_rw, b_light_ratio, num_excjets = num_excjets, prefix = "", norm = False,
-                    min_evts = start_idx, max_evts = stop_idx, sys_str = 'bquark', subjets = subjets1, splittings = splittings1)
-
-            bquark_rw2 = d.reweight_LP(LP_rw, b_light_ratio, num_excjets = num_excjets, prefix = "",  norm = False,
-                    min_evts = start_idx, max_evts = stop_idx, sys_str = 'bquark', subjets = subjets2, splittings = splittings2)
-
-            sys_variations[:,2] = np.array(bquark_rw1) * np.array(bquark_rw2) * weights
-            sys_variations[:,3] = (1./ (np.array(bquark_rw1) * np.array(bquark_rw2))) * weights
-
-
-
+        inputs = d.get_dijet_inputs(start_idx, stop_idx)
+        bquarks = d.get_bquarks_eta_phi(start_idx, stop_idx) if not options.no_sys else None
         mjj = d.f['jet_kinematics'][start_idx:stop_idx,0]
-        add_dset(f_out, "lund_weights", data = weights, )
-        add_dset(f_out, "lund_mjj_check", data = mjj)
-        add_dset(f_out, "lund_weights_stat_var", data = smeared_weights, )
-        add_dset(f_out, "lund_weights_pt_var", data = pt_smeared_weights, )
-        add_dset(f_out, "lund_weights_sys_var", data = sys_variations, )
-
-        add_dset(f_out, "lund_weights_matching", data = bad_match)
-        
-
-        del subjets1, splittings1, weights1, smeared_weights1, pt_smeared_weights1
-        del subjets2, splittings2, weights2, smeared_weights2, pt_smeared_weights2
-        del weights, pt_smeared_weights, smeared_weights, sys_variations
+        return start_idx, stop_idx, inputs, bquarks, mjj
+
+    #with a compact weight format, the raw weights are first saved in a temporary file, 
+    #normalized, and then encoded into the output file
+    compact = (options.weight_format != "float64")
+    f_res = f_out
+    #a single job normalizes its own output, otherwise normalized after merging the jobs
+    if(postprocess is None): postprocess = (options.num_jobs <= 1)
+    if(compact and postprocess):
+        raw_fname = os.path.join(outdir, "lund_weights_raw%i.h5" % options.job_idx)
+        f_res = h5py.File(raw_fname, "w")
+
+    #output datasets created at their final size, chunked by batch
+    n_sys = 4
+    out_shapes = {"lund_weights" : (nevts_batch,), "lund_mjj_check" : (nevts_batch,), "lund_weights_stat_var" : (nevts_batch, nToys), 
+            "lund_weights_pt_var" : (nevts_batch, nToys), "lund_weights_sys_var" : (nevts_batch, n_sys), "lund_weights_matching" : (nevts_batch,)}
+    for key, shape in out_shapes.items():
+        dtype = f_sig['jet_kinematics'].dtype if key == "lund_mjj_check" else np.float64
+        create_dset(f_res, key, shape, dtype = dtype, chunk_rows = batch_size, compression = options.compression)
+
+    def write_batch(start, outputs):
+        for key, data in outputs: write_rows(f_res, key, start, data)
+
+    n_written = 0
+    with AsyncWriter() as writer:
+        for i, (start_idx, stop_idx, inputs, bquarks, mjj) in enumerate(prefetch(read_batch, iters)):
+            if(debug): 
+                snapshots.append(tracemalloc.take_snapshot())
+
+            sys.stdout.flush()
+            print("batch %i \n" %i)
+            print('start, stop', start_idx, stop_idx)
+
+            #cluster, match and reweight both jets in a single pass
+            dijet_splittings = d.get_matched_splittings_dijet(LP_rw, num_excjets = num_excjets, min_evts = start_idx, max_evts = stop_idx, workers = options.workers, 
+                    flat = True, inputs = inputs)
+            del inputs
+
+            weights, smeared_weights, pt_smeared_weights, bad_match = d.reweight_LP_dijet(LP_rw, h_ratio, num_excjets = num_excjets, 
+                    min_evts = start_idx, max_evts = stop_idx, rand_noise = rand_noise, pt_rand_noise = pt_rand_noise, dijet_splittings = dijet_splittings)
+
+            print(len(weights))
+
+
+            sys_variations = np.ones((len(weights), n_sys))
+            if(not options.no_sys):
+                #all variations computed in a single pass over the splittings
+                multi_weights, _ = d.reweight_LP_dijet_multi(LP_rw, sys_ratios + [b_light_ratio], sys_strs = [sys_ + "_" for sys_ in sys_list] + ['bquark'], 
+                        num_excjets = num_excjets, min_evts = start_idx, max_evts = stop_idx, dijet_splittings = dijet_splittings, bquarks = bquarks)
+
+                sys_variations[:,:2] = multi_weights[:,:2]
+                bquark_rw = multi_weights[:,2]
+                sys_variations[:,2] = bquark_rw * weights
+                sys_variations[:,3] = (1./ bquark_rw) * weights
+
+
+            #written in a background thread (in order), while the next batch is processed
+            writer.submit(write_batch, n_written, [("lund_weights", weights), ("lund_mjj_check", mjj), ("lund_weights_stat_var", smeared_weights), 
+                ("lund_weights_pt_var", pt_smeared_weights), ("lund_weights_sys_var", sys_variations), ("lund_weights_matching", bad_match)])
+            n_written += len(weights)
+
+            del dijet_splittings
+            del weights, pt_smeared_weights, smeared_weights, sys_variations
+
+    #less events than allocated if some were masked
+    if(n_written < nevts_batch):
+        for key in out_shapes: f_res[key].resize(n_written, axis = 0)
 
     if(debug): 
         top_stats = snapshots[-1].statistics('lineno')
@@ -245,9 +223,12 @@ def run():
 
 
 
-    postprocess = (options.num_jobs <= 1)
     if(postprocess):
-        h5_postprocess(f_out)
+        h5_postprocess(f_res)
+    if(f_res is not f_out):
+        encode_lund_weights(f_res, f_out, fmt = options.weight_format)
+        f_res.close()
+        os.remove(raw_fname)
 
     f_out.close()
     f_sig.close()
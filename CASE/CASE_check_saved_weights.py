@@ -50,12 +50,12 @@ weights_rw = d.f['lund_weights'][:max_evts]
 print("Mean RW", np.mean(weights_rw))
 print("First weights", weights_rw[:10])
 
-#stat and pt extrapolation toy weights
-weights_stat = d.f['lund_weights_stat_var'][:max_evts]
-weights_pt = d.f['lund_weights_pt_var'][:max_evts]
+#stat and pt extrapolation toy weights (decoded if saved in a compact format)
+weights_stat = read_lund_weights(d.f, 'lund_weights_stat_var', stop = max_evts)
+weights_pt = read_lund_weights(d.f, 'lund_weights_pt_var', stop = max_evts)
 
 #multiply sys variations  by nominal weight
-weights_sys = d.f['lund_weights_sys_var'][:max_evts] * np.expand_dims(weights_rw, -1)
+weights_sys = read_lund_weights(d.f, 'lund_weights_sys_var', stop = max_evts) * np.expand_dims(weights_rw, -1)
 
 #matching unc (single number)
 bad_match_frac = d.f['lund_weights_matching_unc'][0]
@@ -15,12 +15,27 @@ def merge(fin_name, fout):
         
 
 
-def merge_multiple(fout, fs):
+def merge_multiple(fout, fs, chunk_size = 50000):
     print("Merging H5 files: ", fs)
     print(fs[-1])
-    for fin_name in fs:
-        print("Merging %s" % fin_name)
-        merge(fin_name, fout)
+    fins = [h5py.File(fin_name, "r") for fin_name in fs]
+
+    for key in lund_keys:
+        if('matching_unc' in key): continue
+        #output created at its final size (same chunking and compression as the inputs), then filled in order
+        ref = fins[0][key]
+        n_tot = sum([fin[key].shape[0] for fin in fins])
+        chunk_rows = ref.chunks[0] if ref.chunks is not None else 1000
+        create_dset(fout, key, (n_tot,) + ref.shape[1:], dtype = ref.dtype, chunk_rows = chunk_rows, compression = ref.compression)
+
+        start = 0
+        for fin_name, fin in zip(fs, fins):
+            print("Merging %s %s" % (fin_name, key))
+            for sl in chunk_slices(fin[key].shape[0], chunk_size):
+                write_rows(fout, key, start + sl.start, fin[key][sl])
+            start += fin[key].shape[0]
+
+    for fin in fins: fin.close()
 
 
 
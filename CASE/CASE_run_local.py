@@ -0,0 +1,70 @@
+from CASE_merge_jobs import *
+import copy
+import multiprocessing
+
+# compute the Lund plane weights of a CASE signal file on the local machine,
+# replacing the manual --num_jobs / --job_idx slicing + CASE_merge_jobs.py
+# the events are split into --num_jobs slices run in a pool of --n_procs processes, each writing its own output file,
+# the slices are then merged in order into the output file (--fout, the input file if empty) and normalized once
+# syntax is python CASE_run_local.py -i signal.h5 -r ratio.root --num_jobs 8 --n_procs 4 [other CASE_add_lund_weights.py options]
+
+
+def run_slice(options):
+    print("Running slice %i / %i -> %s" % (options.job_idx, options.num_jobs, options.fout))
+    sys.stdout.flush()
+    run(options, postprocess = False)
+    return options.fout
+
+
+def run_local():
+    parser = input_options()
+    parser.add_argument("--n_procs", default=-1, type = int, help="Number of slices run at once (default : all of them)")
+    parser.add_argument("--keep_slices", default=False, action='store_true', help="Keep the output files of each slice")
+    options = parser.parse_args()
+    print(options)
+
+    if(not os.path.exists(options.outdir)): os.system("mkdir %s" % options.outdir)
+    fout_name = options.fout if options.fout != "" else options.fin
+    n_procs = options.n_procs if options.n_procs > 0 else options.num_jobs
+
+    slice_options = []
+    for job_idx in range(options.num_jobs):
+        opts = copy.copy(options)
+        opts.job_idx = job_idx
+        opts.fout = os.path.join(options.outdir, "lund_weights_slice%i.h5" % job_idx)
+        if(os.path.exists(opts.fout)): os.remove(opts.fout)
+        slice_options.append(opts)
+
+    #fresh processes (no state inherited from ROOT in the parent)
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(min(n_procs, options.num_jobs)) as pool:
+        slice_files = pool.map(run_slice, slice_options, chunksize = 1)
+
+    fout = h5py.File(fout_name, "a")
+    for key in lund_keys:
+        if(key in list(fout.keys())):
+            del fout[key]
+
+    #with a compact weight format, slices are merged and normalized in a temporary file, then encoded into the output
+    f_merged = fout
+    if(options.weight_format != "float64"):
+        merged_fname = os.path.join(options.outdir, "lund_weights_merged.h5")
+        f_merged = h5py.File(merged_fname, "w")
+
+    #slices are merged in order of job_idx
+    merge_multiple(f_merged, slice_files)
+    h5_postprocess(f_merged)
+    if(f_merged is not fout):
+        encode_lund_weights(f_merged, fout, fmt = options.weight_format)
+        f_merged.close()
+        os.remove(merged_fname)
+    fout.close()
+
+    if(not options.keep_slices):
+        for fname in slice_files: os.remove(fname)
+
+    print("Done!")
+
+
+if(__name__ == "__main__"):
+    run_local()
@@ -0,0 +1,24 @@
+import sys, os
+sys.path.insert(0, '')
+sys.path.append("../")
+from utils.Utils import *
+""" Recluster all the jets of an h5 file once and save their subjets / splittings (to the file itself or to a separate cache file)
+so that later fill_LP / reweight_LP calls with the same clustering config can skip the reclustering """
+
+parser = input_options()
+parser.add_argument("--cache", default = "", help = "Separate file to save the splittings to (default is the input file)")
+parser.add_argument("--prefix", default = "", help = "Prefix of the saved splittings (use the one passed to reweight_LP / fill_LP)")
+parser.add_argument("--num_excjets", default = 2, type = int, help = "Number of subjets to recluster to")
+parser.add_argument("--unmatched", default = False, action = 'store_true', help = "Plain clustering (as in fill_LP) rather than gen-matched (as in reweight_LP)")
+parser.add_argument("--dtype", default = 1, type = int, help = "Dataset type (1 for CASE h5's)")
+options = parser.parse_args()
+
+f = h5py.File(options.fin, "r" if options.cache != "" else "a")
+f_cache = h5py.File(options.cache, "a") if options.cache != "" else None
+d = Dataset(f, dtype = options.dtype, f_cache = f_cache)
+
+LP_rw = LundReweighter(charge_only = options.charge_only, backend = options.backend)
+d.write_splittings_cache(LP_rw, prefix = options.prefix, num_excjets = options.num_excjets, matched = not options.unmatched, workers = options.workers)
+
+f.close()
+if(f_cache is not None): f_cache.close()
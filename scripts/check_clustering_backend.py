@@ -0,0 +1,43 @@
+import sys, os
+sys.path.insert(0, '')
+sys.path.append("../")
+from utils.Utils import *
+import time
+""" Check that the numba clustering backend (and the fastjet backend with reuse_clustering) 
+reproduces the splittings of the fastjet (reference) backend """
+
+parser = input_options()
+options = parser.parse_args()
+
+fname = "data/example_signal.h5" if options.fin == "" else options.fin
+max_evts = 1000 if options.max_evts < 0 else options.max_evts
+
+f_sig = h5py.File(fname, "r")
+d = Dataset(f_sig, dtype = 1)
+
+pf_cands = d.get_masked("jet1_PFCands").astype(np.float64)[:max_evts]
+ak8_jets = d.get_masked('jet_kinematics')[:max_evts][:,2:6].astype(np.float64)
+
+for num_excjets in [2, 3, 4, -1]:
+
+    LP_rw_fj = LundReweighter(jetR = 1.0, charge_only = options.charge_only, backend = "fastjet", reuse_clustering = False)
+    LP_rw_fj_reuse = LundReweighter(jetR = 1.0, charge_only = options.charge_only, backend = "fastjet", reuse_clustering = True)
+    LP_rw_numba = LundReweighter(jetR = 1.0, charge_only = options.charge_only, backend = "numba")
+
+    #compile before timing
+    LP_rw_numba.get_splittings_batch(pf_cands[:1], num_excjets = num_excjets)
+
+    t0 = time.time()
+    out_fj = LP_rw_fj.get_splittings_batch(pf_cands, num_excjets = num_excjets, rescale_subjets = "vec", rescale_vals = ak8_jets[:,0])
+    t1 = time.time()
+    out_numba = LP_rw_numba.get_splittings_batch(pf_cands, num_excjets = num_excjets, rescale_subjets = "vec", rescale_vals = ak8_jets[:,0])
+    t2 = time.time()
+    out_fj_reuse = LP_rw_fj_reuse.get_splittings_batch(pf_cands, num_excjets = num_excjets, rescale_subjets = "vec", rescale_vals = ak8_jets[:,0])
+    t3 = time.time()
+
+    same = all([np.array_equal(a, b) for a,b in zip(out_fj, out_numba)]) and all([np.array_equal(a, b) for a,b in zip(out_fj, out_fj_reuse)])
+    print("num_excjets %i : %i subjets, %i splittings, identical : %s. fastjet %.2fs, fastjet (reuse_clustering) %.2fs, numba %.2fs" % (num_excjets, 
+        out_fj[0].shape[0], out_fj[2].shape[0], same, t1 - t0, t3 - t2, t2 - t1))
+    if(not same): exit(1)
+
+f_sig.close()
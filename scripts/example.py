@@ -72,63 +72,31 @@ ak8_jets = d.get_masked('jet_kinematics')[:max_evts][:,2:6].astype(np.float64)
 #Nominal event weights of the MC, assume every event is weight '1' for this example
 weights_nom = np.ones(max_evts)
 
-LP_weights = []
-LP_weights_sys_up = []
-LP_weights_sys_down = []
-stat_smeared_weights = []
-pt_smeared_weights = []
-b_weights_up = []
-b_weights_down = []
-bad_matches = []
-
-
-for i,cands in enumerate(pf_cands):
-
-    #Get the subjets, splittings and checking matching based on PF candidates in the jet and gen-level quarks
-    subjets, splittings, bad_match, deltaRs = LP_rw.get_splittings_and_matching(cands, gen_parts_eta_phi[i], ak8_jets[i])
-
-    #Gets the nominal LP reweighting factor for this event and statistical + pt extrapolation toys
-    LP_weight, stat_smeared_weight, pt_smeared_weight = LP_rw.reweight_lund_plane(h_rw = h_ratio, subjets = subjets, splittings = splittings,
-            rand_noise = rand_noise, pt_rand_noise = pt_rand_noise, )
-    #Now get systematic variations
-    LP_weight_sys_up,_,_ = LP_rw.reweight_lund_plane(h_rw = h_ratio_sys_up, subjets = subjets, splittings = splittings)
-    LP_weight_sys_down,_,_ = LP_rw.reweight_lund_plane(h_rw = h_ratio_sys_down, subjets = subjets, splittings = splittings)
-
-
-    #compute special systematic for subjets matched to b quarks
-    #not needed if signal does not specifically produce b quark subjets
-    gen_bs = [j for j in range(len(gen_parts_pdg_ids[i])) if abs(gen_parts_pdg_ids[i,j]) == B_PDG_ID]
-
-    if(len(gen_bs) == 0): b_rw = 1.0
-    else:
-        dists = get_subjet_dist(gen_parts_eta_phi[i,gen_bs,1:3], np.array(subjets)[:,1:3])
-
-        b_matches = []
-        #which subjet is each quark closest to
-        j_closest = np.amin(dists, axis = 0)
-        j_which = np.argmin(dists, axis = 0)
-        b_matches = np.unique(j_which[j_closest < deltaR_cut])
-
-        #reweight only subjets matched to b quarks
-        if(len(b_matches) > 0):
-            b_subjet = [subjet[j] for j in range(len(subjet)) if j in b_matches]
-            b_split  = [split[j]  for j in range(len(split)) if split[j][0] in b_matches]
-
-            b_rw, _,_   = LP_rw.reweight_lund_plane(b_light_ratio, subjets = b_subjet, splittings = b_split, sys_str = 'bquark')
-
-        else: b_rw = 1.0
-
-    b_weights_up.append(LP_weight * b_rw)
-    b_weights_down.append(LP_weight / b_rw)
-
-
-    LP_weights.append(LP_weight)
-    stat_smeared_weights.append(stat_smeared_weight)
-    pt_smeared_weights.append(pt_smeared_weight)
-
-    LP_weights_sys_up.append(LP_weight_sys_up)
-    LP_weights_sys_down.append(LP_weight_sys_down)
-    bad_matches.append(bad_match)
+#Get the subjets, splittings and checking matching based on PF candidates in the jets and gen-level quarks
+#all the jets are processed at once, subjets and splittings are returned as flat arrays + offsets
+subjets, subjet_offsets, splittings, split_offsets, bad_matches, deltaRs = LP_rw.get_splittings_and_matching_batch(pf_cands, 
+        gen_parts_eta_phi, ak8_jets)
+flat_splittings = (subjets, subjet_offsets, splittings, split_offsets)
+
+#Gets the nominal LP reweighting factors and statistical + pt extrapolation toys
+LP_weights, stat_smeared_weights, pt_smeared_weights = LP_rw.reweight_lund_plane_batch(h_ratio, *flat_splittings, 
+        rand_noise = rand_noise, pt_rand_noise = pt_rand_noise)
+
+
+#compute special systematic for subjets matched to b quarks
+#not needed if signal does not specifically produce b quark subjets
+deltaR_cut = 0.2
+is_b = np.abs(gen_parts_pdg_ids) == B_PDG_ID
+b_subjets = get_quark_matched_subjets(gen_parts_eta_phi[is_b], counts_to_offsets(np.sum(is_b, axis = -1)), subjets, subjet_offsets, 
+        deltaR_cut = deltaR_cut)
+
+#Now get systematic variations and the b quark ratio (only applied to the subjets matched to b quarks) in a single pass
+multi_weights = LP_rw.reweight_lund_plane_multi([h_ratio_sys_up, h_ratio_sys_down, b_light_ratio], *flat_splittings, 
+        sys_strs = ["", "", "bquark"], subjet_masks = [None, None, b_subjets])
+LP_weights_sys_up, LP_weights_sys_down, b_rw = multi_weights.T
+
+b_weights_up = LP_weights * b_rw
+b_weights_down = LP_weights / b_rw
 
 
 
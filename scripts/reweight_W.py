@@ -218,13 +218,24 @@ if(do_plot):
 
 LP_rw = LundReweighter(jetR = jetR, charge_only = options.charge_only)
 
-d_data.subjets = d_data.fill_LP(LP_rw, h_data,  num_excjets = num_excjets, prefix = CA_prefix, rescale_subjets = "vec" )
+parallel_fill = (options.workers > 1 or options.checkpoint != "")
+if(parallel_fill):
+    #fill all the samples chunk by chunk in a pool of processes, partial histograms are merged at the end
+    checkpoint = options.checkpoint if options.checkpoint != "" else None
+    fills = [([d_data], h_data, None), (sigs, h_mc, sig_sys_variations), (bkgs, h_bkg, bkg_sys_variations)]
+    LP_fills = fill_LP_parallel(LP_rw, fills, num_excjets = num_excjets, prefix = CA_prefix, rescale_subjets = "vec", workers = options.workers, 
+            checkpoint = checkpoint)
+    for (dsets, _, _), (h_LP, subjets) in zip(fills, LP_fills):
+        for d, d_subjets in zip(dsets, subjets): d.subjets = d_subjets
 
-for d in sigs:
-    d.subjets = d.fill_LP(LP_rw, h_mc,  num_excjets = num_excjets, sys_variations = sig_sys_variations, prefix = CA_prefix,  rescale_subjets = "vec" )
+else:
+    d_data.subjets = d_data.fill_LP(LP_rw, h_data,  num_excjets = num_excjets, prefix = CA_prefix, rescale_subjets = "vec" )
 
-for d in bkgs:
-    d.subjets = d.fill_LP(LP_rw, h_bkg, num_excjets = num_excjets, sys_variations = bkg_sys_variations, prefix = CA_prefix,  rescale_subjets = "vec")
+    for d in sigs:
+        d.subjets = d.fill_LP(LP_rw, h_mc,  num_excjets = num_excjets, sys_variations = sig_sys_variations, prefix = CA_prefix,  rescale_subjets = "vec" )
+
+    for d in bkgs:
+        d.subjets = d.fill_LP(LP_rw, h_bkg, num_excjets = num_excjets, sys_variations = bkg_sys_variations, prefix = CA_prefix,  rescale_subjets = "vec")
 
 
 for d in ([d_data] + sigs + bkgs): 
@@ -239,9 +250,14 @@ for d in ([d_data] + sigs + bkgs):
         sj_pts = []
         for sj in sjs: 
             sj_pts.append(sj[0])
-            h_subjets.Fill(sj[0], weights[idx])
+            if(not parallel_fill): h_subjets.Fill(sj[0], weights[idx])
         d.subjet_pt.append(sj_pts)
 
+#subjet pts were already filled by the workers
+if(parallel_fill):
+    for (h_LP, _), h_subjets in zip(LP_fills, (h_data_subjets, h_mc_subjets, h_bkg_subjets)):
+        h_LP.write_to_hist(h_subjets, subjet_pt = True)
+
 obs.append("subjet_pt")
 
 default = ROOT.TStyle("Default","Default Style");
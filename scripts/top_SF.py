@@ -291,27 +291,28 @@ sys_variations = dict()
 if(do_sys_variations):
     #sys_list = list(sys_weights_map.keys())
     sys_list = ['sys_tot_up', 'sys_tot_down']
-    for sys in sys_list:
-        if(sys == 'nom_weight'): continue
-        sys_ratio = f_ratio.Get("ratio_" + sys)
-        sys_ratio.Print()
-        sys_str = sys + "_"
+    sys_ratios = [f_ratio.Get("ratio_" + sys) for sys in sys_list]
+    sys_strs = [sys + "_" for sys in sys_list]
+    do_bquark = f_ratio.GetListOfKeys().Contains("h_bl_ratio")
+    if(do_bquark):
+        sys_ratios.append(f_ratio.Get("h_bl_ratio"))
+        sys_strs.append('bquark')
+    else:
+        print("bl ratio not found. skipping b quark uncs.")
 
-        sys_LP_weights = d_sig.reweight_LP(LP_rw, sys_ratio, num_excjets = num_excjets, prefix = "", 
-                sys_str = sys_str, subjets = subjets, splittings = splittings)
+    #all variations computed in a single pass over the splittings
+    flat_splittings = flatten_jagged(subjets, 4) + flatten_jagged(splittings, 3)
+    multi_LP_weights = d_sig.reweight_LP_multi(LP_rw, sys_ratios, sys_strs = sys_strs, num_excjets = num_excjets, prefix = "", 
+            flat_splittings = flat_splittings)
 
-        sys_weights = weights_nom[sig_idx] * sys_LP_weights
+    for n,sys in enumerate(sys_list):
+        sys_weights = weights_nom[sig_idx] * multi_LP_weights[:,n]
         rw = np.sum(weights_nom[sig_idx]) / np.sum(sys_weights)
         sys_weights *= rw
         sys_variations[sys] = sys_weights
 
-    if(f_ratio.GetListOfKeys().Contains("h_bl_ratio")):
-        b_light_ratio = f_ratio.Get("h_bl_ratio")
-        bquark_rw = d.reweight_LP(LP_rw, b_light_ratio, num_excjets = num_excjets, prefix = "", 
-                max_evts = max_evts, sys_str = 'bquark', subjets = subjets, splittings = splittings)
-    else:
-        print("bl ratio not found. skipping b quark uncs.")
-        bquark_rw = np.ones_like(weights_rw[sig_idx])
+    if(do_bquark): bquark_rw = multi_LP_weights[:,-1]
+    else: bquark_rw = np.ones_like(weights_rw[sig_idx])
 
     up_bquark_weights = bquark_rw * weights_rw[sig_idx]
     down_bquark_weights = (1./ bquark_rw) * weights_rw[sig_idx]
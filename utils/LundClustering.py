@@ -0,0 +1,282 @@
+""" Array based (numba compiled) reimplementation of the fastjet clustering used by LundReweighter.get_splittings.
+Jets are clustered with the exclusive kt algorithm (E-scheme recombination) and their primary splittings are obtained
+by declustering the clustering history, following the harder branch, exactly as is done with fastjet PseudoJets.
+All the rapidity / phi / distance conventions follow those of fastjet so that both backends give identical splittings. """
+
+import numpy as np
+from numba import njit
+
+MAX_RAP = 1e5
+TWOPI = 2. * np.pi
+#parent index of original particles and index of the beam in the clustering history
+NO_PARENT = -1
+BEAM = -1
+
+
+@njit(cache = True, nogil = True)
+def rap_phi(px, py, pz, E):
+    """Rapidity and phi (in [0, 2pi) ) of a 4 vector, as computed by fastjet"""
+    kt2 = px*px + py*py
+    if(kt2 == 0.0): phi = 0.0
+    else: phi = np.arctan2(py, px)
+    if(phi < 0.0): phi += TWOPI
+    if(phi >= TWOPI): phi -= TWOPI
+
+    if(E == abs(pz) and kt2 == 0.0):
+        max_rap_here = MAX_RAP + abs(pz)
+        if(pz >= 0.0): rap = max_rap_here
+        else: rap = -max_rap_here
+    else:
+        m2 = (E + pz) * (E - pz) - kt2
+        effective_m2 = max(0.0, m2)
+        E_plus_pz = E + abs(pz)
+        rap = 0.5 * np.log((kt2 + effective_m2) / (E_plus_pz * E_plus_pz))
+        if(pz > 0): rap = -rap
+    return rap, phi
+
+
+@njit(cache = True, nogil = True)
+def plain_distance(rap, phi, i, j):
+    """Squared rapidity-phi distance between two nodes"""
+    dphi = abs(phi[i] - phi[j])
+    if(dphi > np.pi): dphi = TWOPI - dphi
+    drap = rap[i] - rap[j]
+    return dphi*dphi + drap*drap
+
+
+@njit(cache = True, nogil = True)
+def pseudorapidity(px, py, pz):
+    if(px == 0.0 and py == 0.0): return MAX_RAP
+    if(pz == 0.0): return 0.0
+    theta = np.arctan(np.sqrt(px*px + py*py) / pz)
+    if(theta < 0): theta += np.pi
+    return -np.log(np.tan(theta / 2.))
+
+
+@njit(cache = True, nogil = True)
+def set_nn(c, slots, n_active, rap, phi, nn, nn_dist, R2):
+    """Find the geometric nearest neighbour (within R) of active slot c"""
+    nn_dist[c] = R2
+    nn[c] = -1
+    for d in range(n_active):
+        if(d == c): continue
+        dist = plain_distance(rap, phi, slots[c], slots[d])
+        if(dist < nn_dist[c]):
+            nn_dist[c] = dist
+            nn[c] = d
+
+
+@njit(cache = True, nogil = True)
+def cluster_kt(cands, start, n, cand_good, R2, mom, rap, phi, kt2, parent1, parent2, good, slots, nn, nn_dist, recompute):
+    """Run the kt clustering of the n candidates cands[start:start+n].
+    Fills the clustering history (nodes 0..n-1 are the input particles, each later node is a recombination step).
+    Pairwise recombinations also create a jet with the same index, recombinations with the beam have parent2 = BEAM.
+    Returns the length of the history (2n)."""
+
+    for i in range(n):
+        for k in range(4): mom[i,k] = cands[start + i, k]
+        kt2[i] = mom[i,0]*mom[i,0] + mom[i,1]*mom[i,1]
+        rap[i], phi[i] = rap_phi(mom[i,0], mom[i,1], mom[i,2], mom[i,3])
+        parent1[i] = NO_PARENT
+        parent2[i] = NO_PARENT
+        good[i] = cand_good[start + i]
+        slots[i] = i
+
+    n_hist = n
+    n_active = n
+
+    for c in range(n_active):
+        nn_dist[c] = R2
+        nn[c] = -1
+    for c in range(n_active):
+        for d in range(c+1, n_active):
+            dist = plain_distance(rap, phi, slots[c], slots[d])
+            if(dist < nn_dist[c]):
+                nn_dist[c] = dist
+                nn[c] = d
+            if(dist < nn_dist[d]):
+                nn_dist[d] = dist
+                nn[d] = c
+
+    while(n_active > 0):
+        #smallest of the d_ij, d_iB
+        best = -1
+        d_min = 0.
+        for c in range(n_active):
+            k = kt2[slots[c]]
+            if(nn[c] >= 0 and kt2[slots[nn[c]]] < k): k = kt2[slots[nn[c]]]
+            d = nn_dist[c] * k
+            if(best < 0 or d < d_min):
+                best = c
+                d_min = d
+
+        a = best
+        b = nn[a]
+        last = n_active - 1
+        if(b >= 0):
+            ia = slots[a]
+            ib = slots[b]
+            new = n_hist
+            for k in range(4): mom[new,k] = mom[ia,k] + mom[ib,k]
+            kt2[new] = mom[new,0]*mom[new,0] + mom[new,1]*mom[new,1]
+            rap[new], phi[new] = rap_phi(mom[new,0], mom[new,1], mom[new,2], mom[new,3])
+            parent1[new] = min(ia, ib)
+            parent2[new] = max(ia, ib)
+            good[new] = good[ia] or good[ib]
+            n_hist += 1
+
+            lo = min(a, b)
+            hi = max(a, b)
+            slots[lo] = new
+            if(hi != last):
+                slots[hi] = slots[last]
+                nn[hi] = nn[last]
+                nn_dist[hi] = nn_dist[last]
+            n_active -= 1
+
+            for c in range(n_active):
+                old = nn[c]
+                recompute[c] = (c == lo) or (old == lo) or (old == hi)
+                if(not recompute[c] and old == last): nn[c] = hi
+
+            for c in range(n_active):
+                if(recompute[c]): set_nn(c, slots, n_active, rap, phi, nn, nn_dist, R2)
+
+            for c in range(n_active):
+                if(c == lo or recompute[c]): continue
+                dist = plain_distance(rap, phi, slots[c], new)
+                if(dist < nn_dist[c]):
+                    nn_dist[c] = dist
+                    nn[c] = lo
+
+        else:
+            #recombine with the beam
+            parent1[n_hist] = slots[a]
+            parent2[n_hist] = BEAM
+            n_hist += 1
+
+            if(a != last):
+                slots[a] = slots[last]
+                nn[a] = nn[last]
+                nn_dist[a] = nn_dist[last]
+            n_active -= 1
+
+            for c in range(n_active):
+                old = nn[c]
+                recompute[c] = (old == a)
+                if(not recompute[c] and old == last): nn[c] = a
+            for c in range(n_active):
+                if(recompute[c]): set_nn(c, slots, n_active, rap, phi, nn, nn_dist, R2)
+
+    return n_hist
+
+
+@njit(cache = True, nogil = True)
+def cluster_batch(cands, cand_offsets, cand_good, num_excjets, R, max_jets):
+    """Cluster a batch of jets and decluster their subjets into primary Lund plane splittings.
+
+    cands : (n_cands, 4) array of the (px, py, pz, E) of all the (already cleaned) candidates of all jets
+    cand_offsets : (N+1) offsets of the candidates of each jet into cands
+    cand_good : (n_cands) bool array, subjets without any 'good' candidate are dropped (exclusive clustering only)
+    num_excjets : (N) number of exclusive subjets for each jet (< 0 for inclusive jets)
+    R : jet radius of the kt clustering
+    max_jets : maximum number of inclusive jets to keep (< 0 for all)
+
+    Returns : (subjets, subjet_counts, splittings, split_counts, total_pts) with subjets the unscaled (pt, eta, phi, m) of
+    each subjet, splittings the (subjet_idx, deltaR, kt) of each splitting and total_pts the pt of the sum of the subjets of each jet.
+    """
+
+    n_jets = len(cand_offsets) - 1
+    n_cands = cands.shape[0]
+    R2 = R*R
+
+    max_n = 0
+    for i in range(n_jets):
+        max_n = max(max_n, cand_offsets[i+1] - cand_offsets[i])
+
+    n_nodes = 2*max_n + 1
+    mom = np.zeros((n_nodes, 4))
+    rap = np.zeros(n_nodes)
+    phi = np.zeros(n_nodes)
+    kt2 = np.zeros(n_nodes)
+    parent1 = np.zeros(n_nodes, dtype = np.int64)
+    parent2 = np.zeros(n_nodes, dtype = np.int64)
+    good = np.zeros(n_nodes, dtype = np.bool_)
+    slots = np.zeros(n_nodes, dtype = np.int64)
+    nn = np.zeros(n_nodes, dtype = np.int64)
+    nn_dist = np.zeros(n_nodes)
+    recompute = np.zeros(n_nodes, dtype = np.bool_)
+    jets = np.zeros(n_nodes, dtype = np.int64)
+
+    #each subjet contains at least one candidate, each splitting removes one
+    subjets = np.zeros((n_cands, 4))
+    splittings = np.zeros((n_cands, 3))
+    subjet_counts = np.zeros(n_jets, dtype = np.int64)
+    split_counts = np.zeros(n_jets, dtype = np.int64)
+    total_pts = np.zeros(n_jets)
+    n_sj = 0
+    n_split = 0
+
+    for i in range(n_jets):
+        start = cand_offsets[i]
+        n = cand_offsets[i+1] - start
+        n_hist = cluster_kt(cands, start, n, cand_good, R2, mom, rap, phi, kt2, parent1, parent2, good, slots, nn, nn_dist, recompute)
+
+        n_js = 0
+        if(num_excjets[i] < 0):
+            for h in range(n_hist - 1, n - 1, -1):
+                if(parent2[h] == BEAM):
+                    jets[n_js] = parent1[h]
+                    n_js += 1
+        else:
+            stop = 2*n - min(num_excjets[i], n)
+            for h in range(stop, n_hist):
+                if(parent1[h] < stop):
+                    jets[n_js] = parent1[h]
+                    n_js += 1
+                if(parent2[h] < stop and parent2[h] > 0):
+                    jets[n_js] = parent2[h]
+                    n_js += 1
+
+        order = np.argsort(-kt2[jets[:n_js]], kind = 'mergesort')
+
+        if(num_excjets[i] < 0 and max_jets > 0): n_keep = min(n_js, max_jets)
+        else: n_keep = n_js
+
+        tot_px = 0.
+        tot_py = 0.
+        sj_idx = 0
+        for o in range(n_keep):
+            j = jets[order[o]]
+            if(num_excjets[i] >= 0 and not good[j]): continue
+
+            px, py, pz, E = mom[j,0], mom[j,1], mom[j,2], mom[j,3]
+            m2 = (E + pz) * (E - pz) - kt2[j]
+            subjets[n_sj, 0] = np.sqrt(kt2[j])
+            subjets[n_sj, 1] = pseudorapidity(px, py, pz)
+            subjets[n_sj, 2] = phi[j]
+            subjets[n_sj, 3] = -np.sqrt(-m2) if m2 < 0.0 else np.sqrt(m2)
+            n_sj += 1
+            tot_px += px
+            tot_py += py
+
+            #primary declustering, following the harder branch
+            node = j
+            while(node >= n):
+                j1 = parent1[node]
+                j2 = parent2[node]
+                if(np.sqrt(kt2[j2]) > np.sqrt(kt2[j1])): j1, j2 = j2, j1
+                delta = np.sqrt(plain_distance(rap, phi, j1, j2))
+                splittings[n_split, 0] = sj_idx
+                splittings[n_split, 1] = delta
+                splittings[n_split, 2] = np.sqrt(kt2[j2]) * delta
+                n_split += 1
+                split_counts[i] += 1
+                node = j1
+
+            subjet_counts[i] += 1
+            sj_idx += 1
+
+        total_pts[i] = np.sqrt(tot_px*tot_px + tot_py*tot_py)
+
+    return subjets[:n_sj], subjet_counts, splittings[:n_split], split_counts, total_pts
@@ -0,0 +1,147 @@
+""" Array based Lund plane histograms.
+Splittings of a whole batch of jets are binned at once (with the same binning conventions as ROOT's TAxis::FindBin)
+and accumulated for several weight variations (nominal + systematics) in a single pass.
+Contents are only copied into ROOT histograms when they are written out. """
+
+import numpy as np
+
+
+def get_axis_binning(axis):
+    """Bin edges of a ROOT TAxis and whether it has fixed size bins (in which case ROOT computes bin numbers arithmetically)"""
+    n = axis.GetNbins()
+    xbins = axis.GetXbins()
+    if(xbins.GetSize() > 0):
+        return np.array([xbins[i] for i in range(n+1)], dtype = np.float64), False
+    return np.linspace(axis.GetXmin(), axis.GetXmax(), n+1), True
+
+
+def find_bins(x, edges, uniform = False):
+    """Vectorized TAxis::FindBin. Returns bin numbers in [0, n+1] (0 is the underflow, n+1 the overflow)"""
+    x = np.asarray(x, dtype = np.float64)
+    n = len(edges) - 1
+    if(uniform):
+        xmin, xmax = edges[0], edges[-1]
+        with np.errstate(invalid = 'ignore'):
+            bins = 1 + (n * (x - xmin) / (xmax - xmin)).astype(np.int64, casting = 'unsafe')
+            bins = np.where(x < xmin, 0, np.where(x < xmax, bins, n+1))
+        return bins
+    #NaN's go to the overflow, as in ROOT
+    return np.searchsorted(edges, x, side = 'right')
+
+
+def get_lund_coords(subjets, subjet_offsets, splittings, split_offsets, dR = 0.8, subjet_idx = -1, return_subjet_idxs = False):
+    """Lund plane coordinates (subjet pt, ln(dR/delta), ln(kt)) of all the splittings of a batch of jets (flat arrays + offsets,
+    see LundReweighter.get_splittings_batch).
+    Returns the three coordinates and the index of the jet of each splitting, only for the splittings with delta > 0 and kt > 0
+    (and, if return_subjet_idxs, the index of their subjet in the flat subjets array)"""
+
+    split_counts = np.diff(split_offsets)
+    jet_idxs = np.repeat(np.arange(len(split_counts)), split_counts)
+    splittings = np.asarray(splittings).reshape(-1, 3)
+    subjet_idxs = np.round(splittings[:,0]).astype(np.int64)
+
+    keep = (splittings[:,1] > 0.) & (splittings[:,2] > 0.)
+    if(subjet_idx >= 0): keep &= (splittings[:,0] == subjet_idx)
+
+    jet_idxs = jet_idxs[keep]
+    splittings = splittings[keep]
+    subjet_idxs = subjet_idxs[keep]
+
+    #jets with a single subjet always use it
+    single = (subjet_offsets[jet_idxs + 1] - subjet_offsets[jet_idxs]) == 1
+    subjet_idxs[single] = 0
+    flat_subjet_idxs = subjet_offsets[jet_idxs] + subjet_idxs
+    subjet_pts = np.asarray(subjets).reshape(-1, 4)[flat_subjet_idxs, 0]
+
+    if(return_subjet_idxs): return subjet_pts, np.log(dR / splittings[:,1]), np.log(splittings[:,2]), jet_idxs, flat_subjet_idxs
+    return subjet_pts, np.log(dR / splittings[:,1]), np.log(splittings[:,2]), jet_idxs
+
+
+
+class LundPlaneHist():
+    """Lund plane histogram (subjet pt, ln(0.8/delta), ln(kt)) for n_var weight variations, stored as numpy arrays of
+    sum of weights and sum of weights squared of shape (n_var, n_pt+2, n_dR+2, n_kt+2) (including under/overflow bins, as ROOT).
+    Subjet pt distributions (used to normalize the ratio) can be accumulated alongside"""
+
+    def __init__(self, pt_bins, dr_bins, kt_bins, n_var = 1, var_names = None, dR = 0.8, uniform = (False, False, False)):
+        self.edges = [np.asarray(pt_bins, dtype = np.float64), np.asarray(dr_bins, dtype = np.float64), np.asarray(kt_bins, dtype = np.float64)]
+        self.uniform = tuple(uniform)
+        self.n_var = n_var
+        self.var_names = list(var_names) if var_names is not None else [str(i) for i in range(n_var)]
+        self.dR = dR
+        self.shape = tuple(len(e) + 1 for e in self.edges)
+        self.sumw = np.zeros((n_var,) + self.shape)
+        self.sumw2 = np.zeros((n_var,) + self.shape)
+        self.subjet_pt_sumw = np.zeros((n_var, self.shape[0]))
+        self.subjet_pt_sumw2 = np.zeros((n_var, self.shape[0]))
+        self.entries = 0
+
+    @classmethod
+    def from_hist(cls, h, n_var = 1, var_names = None, dR = 0.8):
+        """Empty LundPlaneHist with the same binning as a ROOT TH3"""
+        binnings = [get_axis_binning(ax) for ax in (h.GetXaxis(), h.GetYaxis(), h.GetZaxis())]
+        return cls(*[b[0] for b in binnings], n_var = n_var, var_names = var_names, dR = dR, uniform = [b[1] for b in binnings])
+
+    def empty_like(self):
+        return LundPlaneHist(*self.edges, n_var = self.n_var, var_names = self.var_names, dR = self.dR, uniform = self.uniform)
+
+    def find_bins(self, pt, dr, kt):
+        """Global (flattened) bin numbers of some points"""
+        bins = [find_bins(v, e, u) for v, e, u in zip((pt, dr, kt), self.edges, self.uniform)]
+        return np.ravel_multi_index(bins, self.shape)
+
+    def accumulate(self, sumw, sumw2, bins, weights):
+        """Add weights (n_var, n) to the flattened bins of a (n_var, ...) array with a single bincount"""
+        n_bins = int(np.prod(sumw.shape[1:]))
+        weights = np.asarray(weights, dtype = np.float64).reshape(self.n_var, -1)
+        idxs = (bins[np.newaxis, :] + n_bins * np.arange(self.n_var)[:, np.newaxis]).reshape(-1)
+        sumw += np.bincount(idxs, weights = weights.reshape(-1), minlength = n_bins * self.n_var).reshape(sumw.shape)
+        sumw2 += np.bincount(idxs, weights = np.square(weights).reshape(-1), minlength = n_bins * self.n_var).reshape(sumw.shape)
+
+    def fill(self, subjets, subjet_offsets, splittings, split_offsets, weights, subjet_idx = -1, fill_subjet_pt = False):
+        """Fill the splittings of a batch of N jets (flat arrays + offsets). weights is an array of shape (n_var, N)
+        (or (N) for a single variation) with the weight of each jet for each variation"""
+        weights = np.asarray(weights, dtype = np.float64).reshape(self.n_var, -1)
+        pt, dr, kt, jet_idxs = get_lund_coords(subjets, subjet_offsets, splittings, split_offsets, dR = self.dR, subjet_idx = subjet_idx)
+        self.accumulate(self.sumw, self.sumw2, self.find_bins(pt, dr, kt), weights[:, jet_idxs])
+        self.entries += len(jet_idxs)
+
+        if(fill_subjet_pt): self.fill_subjet_pt(subjets, subjet_offsets, weights)
+
+    def fill_subjet_pt(self, subjets, subjet_offsets, weights):
+        """Fill the pt of all the subjets of a batch of jets into the subjet pt histograms.
+        Jets without any subjet count as a single subjet of pt 0 (as the subjets returned by Dataset.fill_LP)"""
+        weights = np.asarray(weights, dtype = np.float64).reshape(self.n_var, -1)
+        counts = np.diff(subjet_offsets)
+        empty = np.nonzero(counts == 0)[0]
+        jet_idxs = np.concatenate([np.repeat(np.arange(len(counts)), counts), empty])
+        pts = np.concatenate([np.asarray(subjets).reshape(-1, 4)[:,0], np.zeros(len(empty))])
+        bins = find_bins(pts, self.edges[0], self.uniform[0])
+        self.accumulate(self.subjet_pt_sumw, self.subjet_pt_sumw2, bins, weights[:, jet_idxs])
+
+    def add(self, other):
+        """Merge another (partial) histogram with the same binning into this one"""
+        self.sumw += other.sumw
+        self.sumw2 += other.sumw2
+        self.subjet_pt_sumw += other.subjet_pt_sumw
+        self.subjet_pt_sumw2 += other.subjet_pt_sumw2
+        self.entries += other.entries
+        return self
+
+    def write_to_hist(self, h, var = 0, add = True, subjet_pt = False):
+        """Copy the contents of one variation into a ROOT histogram (TH3 or, if subjet_pt, the TH1 of subjet pts).
+        If add, the contents are added to those already in the histogram"""
+        if(not add): h.Reset()
+        h.Sumw2()
+        sumw = self.subjet_pt_sumw[var] if subjet_pt else self.sumw[var]
+        sumw2 = self.subjet_pt_sumw2[var] if subjet_pt else self.sumw2[var]
+        for idx in zip(*np.nonzero((sumw != 0.) | (sumw2 != 0.))):
+            idx = tuple(int(i) for i in idx)
+            cont, err2 = sumw[idx], sumw2[idx]
+            if(add):
+                cont += h.GetBinContent(*idx)
+                err2 += h.GetBinError(*idx)**2
+            h.SetBinContent(*(idx + (cont,)))
+            h.SetBinError(*(idx + (np.sqrt(err2),)))
+        if(not subjet_pt): h.SetEntries(h.GetEntries() + self.entries)
+        return h
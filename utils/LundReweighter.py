@@ -4,9 +4,14 @@ import fastjet as fj
 import numpy as np
 import sys
 from .PlotUtils import *
+from .LundPlaneHist import *
+from .RatioTable import *
+from .ToyNoise import *
 import ROOT
 from array import array
 import copy
+import json
+import hashlib
 
 def cleanup_hist(h):
     if(type(h) == ROOT.TH3F):
@@ -78,10 +83,118 @@ def get_subjet_dist(q_eta_phis, subjets_eta_phis):
     return np.sqrt(np.square(subjets_eta_phis[:,:,0] - q_eta_phis[:,:,0]) + 
             np.square(ang_dist(subjets_eta_phis[:,:,1], q_eta_phis[:,:,1] )))
 
+def get_dRs_batch(gen_eta_phi, j_4vecs):
+    """Batched get_dRs for a padded (N, n_gen, 2) array of gen particles and an (N, 4) array of jet 4 vectors"""
+    return np.sqrt(np.square(gen_eta_phi[:,:,0] - j_4vecs[:,1:2]) + 
+            np.square(ang_dist(gen_eta_phi[:,:,1], j_4vecs[:,2:3] )))
+
+def match_subjets_batch(q_eta_phis, q_mask, subjets_eta_phis, subjet_mask, gen_dRs = None, deltaR_cut = 0.2):
+    """Batched check_bad_subjet_matching. Takes padded (N, max_quarks, 2) quark and (N, max_subjets, 2) subjet (eta, phi) arrays
+    and masks flagging their valid entries. 
+    Returns the bad_match flag of each event (some subjet not within deltaR_cut of a quark or two subjets matched to the same quark), 
+    the distance of each subjet to its closest quark (inf for padding) and, if the distances of the quarks to the jet axis (gen_dRs) are given,
+    whether any quark is near the boundary of the jet (0.7 < dR < 0.9)"""
+
+    dists = np.sqrt(np.square(subjets_eta_phis[:,:,np.newaxis,0] - q_eta_phis[:,np.newaxis,:,0]) + 
+            np.square(ang_dist(subjets_eta_phis[:,:,np.newaxis,1], q_eta_phis[:,np.newaxis,:,1] )))
+    dists[~np.broadcast_to(q_mask[:,np.newaxis,:], dists.shape)] = np.inf
+
+    if(dists.shape[-1] > 0):
+        j_closest = np.amin(dists, axis = -1)
+        j_which = np.argmin(dists, axis = -1)
+    else:
+        j_closest = np.full(dists.shape[:2], np.inf)
+        j_which = np.zeros(dists.shape[:2], dtype = np.int64)
+    j_closest[~subjet_mask] = np.inf
+
+    #check all subjets within deltaR_cut of a quark and no two subjets matched to same quark
+    matched = j_closest < deltaR_cut
+    no_match = np.sum(matched, axis = -1) != np.sum(subjet_mask, axis = -1)
+    n_matches = np.sum((j_which[:,:,np.newaxis] == np.arange(dists.shape[-1])) & matched[:,:,np.newaxis], axis = 1)
+    repeats = np.any(n_matches > 1, axis = -1)
+    bad_match = no_match | repeats
+
+    boundary = None
+    if(gen_dRs is not None): boundary = np.any((gen_dRs > 0.7) & (gen_dRs < 0.9) & q_mask, axis = -1)
+
+    return bad_match, j_closest, boundary
+
+def get_quark_matched_subjets(q_eta_phi, q_offsets, subjets, subjet_offsets, deltaR_cut = 0.2):
+    """Flag the subjets (flat array + offsets) that are the closest subjet of one of the quarks of their jet (flat (eta, phi) 
+    array + offsets), within deltaR_cut. Used to only reweight the subjets matched to b quarks"""
+    q_eta_phi = np.asarray(q_eta_phi, dtype = np.float64).reshape(-1, 2)
+    subjets = np.asarray(subjets, dtype = np.float64).reshape(-1, 4)
+    matched = np.zeros(len(subjets), dtype = bool)
+    if(len(q_eta_phi) == 0 or len(subjets) == 0): return matched
+
+    qs, q_mask = pad_jagged(q_eta_phi, q_offsets)
+    sjs, sj_mask = pad_jagged(subjets[:, 1:3], subjet_offsets)
+    dists = np.sqrt(np.square(sjs[:, np.newaxis, :, 0] - qs[:, :, np.newaxis, 0]) + np.square(ang_dist(sjs[:, np.newaxis, :, 1], qs[:, :, np.newaxis, 1])))
+    dists[~np.broadcast_to(sj_mask[:, np.newaxis, :], dists.shape)] = np.inf
+
+    #closest subjet to each quark
+    j_which = np.argmin(dists, axis = -1)
+    j_closest = np.take_along_axis(dists, j_which[..., np.newaxis], axis = -1)[..., 0]
+    good = q_mask & (j_closest < deltaR_cut)
+    jet_idxs = np.broadcast_to(np.arange(len(qs))[:, np.newaxis], good.shape)
+    matched[subjet_offsets[jet_idxs[good]] + j_which[good]] = True
+    return matched
+
+def counts_to_offsets(counts):
+    """Convert per-jet counts into (N+1) offsets into a flat array"""
+    offsets = np.zeros(len(counts) + 1, dtype = np.int64)
+    np.cumsum(counts, out = offsets[1:])
+    return offsets
+
+def split_jagged(values, offsets):
+    """Split a flat array into a list of per-jet arrays based on its offsets"""
+    if(len(offsets) <= 1): return []
+    return np.split(values, offsets[1:-1])
+
+def take_jagged(values, offsets, idxs):
+    """Select the entries of some jets (idxs) from a flat array. Returns the selected values and their new offsets"""
+    idxs = np.asarray(idxs, dtype = np.int64)
+    counts = offsets[idxs + 1] - offsets[idxs]
+    new_offsets = counts_to_offsets(counts)
+    pos = np.repeat(offsets[idxs] - new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+    return values[pos], new_offsets
+
+def pad_jagged(values, offsets, fill = 0.):
+    """Convert a flat array and its offsets into a padded (N, max_n, ...) array. Also returns the mask of the valid entries"""
+    counts = np.diff(offsets)
+    max_n = np.amax(counts, initial = 0)
+    mask = np.arange(max_n) < counts[:, np.newaxis]
+    padded = np.full((len(counts), max_n) + values.shape[1:], fill, dtype = values.dtype)
+    padded[mask] = values
+    return padded, mask
+
+def flatten_jagged(values_list, width):
+    """Inverse of split_jagged, converts a list of per-jet (n_i, width) values into a flat array and its offsets"""
+    values_list = [np.asarray(v, dtype = np.float64).reshape(-1, width) for v in values_list]
+    offsets = counts_to_offsets([len(v) for v in values_list])
+    if(offsets[-1] == 0): return np.zeros((0, width)), offsets
+    return np.concatenate(values_list), offsets
+
+def concat_jagged(values_list, offsets_list):
+    """Concatenate several flat arrays (and their offsets) of consecutive blocks of jets"""
+    offsets = [np.zeros(1, dtype = np.int64)]
+    shift = 0
+    for offs in offsets_list:
+        offsets.append(offs[1:] + shift)
+        shift += offs[-1]
+    return np.concatenate(values_list), np.concatenate(offsets)
+
 
 class LundReweighter():
 
-    def __init__(self, jetR = -1, maxJets = -1, dR = 0.8, pt_extrap_dir = None, pt_extrap_val = 350., pf_pt_min = 1.0, charge_only = False) :
+    def __init__(self, jetR = -1, maxJets = -1, dR = 0.8, pt_extrap_dir = None, pt_extrap_val = 350., pf_pt_min = 1.0, charge_only = False, backend = "fastjet", 
+            reuse_clustering = True) :
+        """ backend : Clustering backend used to compute the splittings. 'fastjet' (reference) or 'numba' (compiled array based 
+        reimplementation in LundClustering, gives identical splittings but is much faster for large batches of jets)
+        reuse_clustering : (fastjet backend) Reuse the same JetDefinitions for all jets and decluster the subjets directly from the
+        exclusive kt clustering, without building a CA ClusterSequence for each subjet. Splittings are identical, 
+        set to False to get the old (slower) behavior, eg. for timing comparisons
+        """
 
         self.jetR = jetR
         self.maxJets = maxJets
@@ -94,7 +207,39 @@ class LundReweighter():
         self.max_rw = 5.
         self.min_rw = 0.2
         self.func_dict = {}
-
+        #axis binnings and RatioTables of the ratio histograms, extracted once per histogram
+        self.hist_binnings = {}
+        self.ratio_tables = {}
+        self.pt_extrap_tables = {}
+
+        if(backend not in ("fastjet", "numba")):
+            print("Invalid clustering backend %s!" % backend)
+            exit(1)
+        self.backend = backend
+        self.reuse_clustering = reuse_clustering
+        self.jet_defs = {}
+
+
+    def clustering_config(self):
+        """Settings needed to reproduce the clustering of this LundReweighter (eg. in a worker process)"""
+        return {'jetR' : self.jetR, 'maxJets' : self.maxJets, 'pf_pt_min' : self.pf_pt_min, 'charge_only' : self.charge_only, 'backend' : self.backend, 
+                'reuse_clustering' : self.reuse_clustering}
+
+    def get_jet_def(self, jet_algo, R):
+        """JetDefinition for the given algorithm and radius, shared by all the jets clustered with this LundReweighter if reuse_clustering"""
+        if(not self.reuse_clustering): return fj.JetDefinition(jet_algo, R)
+        key = (jet_algo, R)
+        if(key not in self.jet_defs): self.jet_defs[key] = fj.JetDefinition(jet_algo, R)
+        return self.jet_defs[key]
+
+    def cache_hash(self, num_excjets = -1, rescale_subjets = "", matched = True):
+        """Hash identifying the subjets/splittings produced by a given clustering config, used to tag saved splittings. 
+        The backend (and reuse_clustering) is not included since they all give identical splittings"""
+        config = self.clustering_config()
+        del config['backend'], config['reuse_clustering']
+        config.update({'num_excjets' : int(num_excjets), 'rescale_subjets' : rescale_subjets, 'matched' : bool(matched)})
+        config_str = json.dumps(config, sort_keys = True)
+        return hashlib.sha1(config_str.encode()).hexdigest()[:16], config_str
 
 
     def check_bad_subjet_matching(self, gen_parts_eta_phi, subjets):
@@ -148,6 +293,43 @@ class LundReweighter():
 
 
 
+    def get_splittings_and_matching_batch(self, pf_cands, gen_particles_eta_phi, ak8_jets, rescale_subjets = "", rescale_vals = None, n_pfs = None, 
+            gen_mask = None):
+        """Batched version of get_splittings_and_matching. 
+        pf_cands is an array of shape (N, nPF, F) of zero-padded PF candidates, gen_particles_eta_phi a list of the 
+        (eta, phi) of the gen particles of each jet (or a padded (N, n_gen, 2) array with gen_mask flagging its valid entries)
+        and ak8_jets an (N, 4) array of AK8 jet 4 vectors (pt, eta, phi, M).
+        n_pfs (optional) is the number of PF candidates of each jet.
+
+        Returns : 
+        A tuple (subjets, subjet_offsets, splittings, split_offsets, bad_matches, dRs), see get_splittings_batch for the format 
+        of the subjets and splittings.
+        """
+
+        if(gen_mask is None):
+            if(isinstance(gen_particles_eta_phi, np.ndarray) and gen_particles_eta_phi.ndim == 3):
+                gen_mask = np.ones(gen_particles_eta_phi.shape[:2], dtype = bool)
+            else:
+                gen_particles_eta_phi, gen_mask = pad_jagged(np.concatenate([np.reshape(g, (-1, 2)) for g in gen_particles_eta_phi] + [np.zeros((0,2))]), 
+                        counts_to_offsets([len(g) for g in gen_particles_eta_phi]))
+
+        gen_dRs = get_dRs_batch(gen_particles_eta_phi, ak8_jets)
+        #ensure at least 1 prong or reclustering will crash
+        n_prongs = np.maximum(1, np.sum((gen_dRs < 0.8) & gen_mask, axis = -1))
+
+        subjets, subjet_offsets, splittings, split_offsets = self.get_splittings_batch(pf_cands, num_excjets = n_prongs, 
+                rescale_subjets = rescale_subjets, rescale_vals = rescale_vals, n_pfs = n_pfs)
+
+        #check subjets matched to quarks and if quarks near boundary of jet
+        subjets_eta_phi, subjet_mask = pad_jagged(subjets[:,1:3], subjet_offsets)
+        subjet_bad_match, _, boundary = match_subjets_batch(gen_particles_eta_phi, gen_mask, subjets_eta_phi, subjet_mask, gen_dRs = gen_dRs)
+        bad_matches = list(subjet_bad_match | boundary)
+
+        dRs = split_jagged(gen_dRs[gen_mask], counts_to_offsets(np.sum(gen_mask, axis = -1)))
+
+        return subjets, subjet_offsets, splittings, split_offsets, bad_matches, dRs
+
+
     def get_splittings(self, pf_cands, num_excjets = -1, rescale_subjets = "", rescale_val = 1.0):
         """Given a list of pf_candidates (px, py,pz,E), recluster into a given (num_excjets) number of subjets (-1 for variable number, not recommended). 
         the momentum of these subjets is scaled based on the rescale_subjets and rescale_val args.
@@ -159,22 +341,124 @@ class LundReweighter():
         rescale_val (optional): Value used in subjet scaling.
         """
 
-        pjs = []
-        pfs_cut = []
-        for i,c in enumerate(pf_cands):
-            if(c[3] > 0.0001):
-                pj = fj.PseudoJet(c[0], c[1], c[2], c[3])
+        if(self.backend != "fastjet"):
+            subjets, _, splittings, _ = self.get_splittings_batch(np.asarray(pf_cands, dtype = np.float64)[np.newaxis], num_excjets = num_excjets, 
+                    rescale_subjets = rescale_subjets, rescale_vals = [rescale_val])
+            return subjets.tolist(), splittings.tolist()
+
+        pf_cands = np.asarray(pf_cands)
+        pf_cands = pf_cands[pf_cands[:,3] > 0.0001]
+        subjets, splittings, total_pt = self.cluster_jet(pf_cands, num_excjets = num_excjets)
+
+        #Rescale subjet momenta
+        if(rescale_subjets == "jec"):
+            for i in range(len(subjets)):
+                subjets[i][0] *= rescale_val
+        elif(rescale_subjets == "vec"):
+            rescale_val = rescale_val / total_pt
+            for i in range(len(subjets)):
+                subjets[i][0] *= rescale_val
+
+        return subjets, splittings
+
+
+    def preselect_pf_cands(self, pf_cands, n_pfs = None):
+        """Remove the zero-padding of a block of PF candidates (N, nPF, F) with a single mask over the whole block.
+        n_pfs (optional) : number of PF candidates of each jet, used to trim the padding before applying the energy cut
+
+        Returns : the (n_cands, F) array of the remaining candidates, the (N+1) offsets of the candidates of each jet and
+        a (n_cands) bool array of the candidates passing the pt (and charge) cuts. 
+        Subjets without any of these 'good' candidates are dropped."""
+
+        if(n_pfs is not None):
+            n_pfs = np.minimum(np.asarray(n_pfs).astype(np.int64), pf_cands.shape[1])
+            pf_cands = pf_cands[:, :np.amax(n_pfs, initial = 0)]
+            keep = (np.arange(pf_cands.shape[1]) < n_pfs[:, np.newaxis]) & (pf_cands[:,:,3] > 0.0001)
+        else:
+            keep = pf_cands[:,:,3] > 0.0001
+
+        cands = np.ascontiguousarray(pf_cands[keep], dtype = np.float64)
+        good = np.sqrt(cands[:,0]*cands[:,0] + cands[:,1]*cands[:,1]) > self.pf_pt_min
+        #5th entry is charge of PFCand
+        if(self.charge_only): good &= np.abs(cands[:,5]) > 1e-4
+
+        return cands, counts_to_offsets(np.sum(keep, axis = -1)), good
 
-                if(pj.pt() > 1.0):
-                    pfs_cut.append(c)
 
-                pjs.append(pj)
+    def get_splittings_batch(self, pf_cands, num_excjets = -1, rescale_subjets = "", rescale_vals = None, n_pfs = None):
+        """Batched version of get_splittings. Reclusters a whole block of jets and returns flat arrays instead of lists of lists.
+
+        pf_cands : Array of shape (N, nPF, F) of zero-padded PF candidates (px, py, pz, E, ...) 
+        num_excjets (optional): Number of subjets to recluster to, either a single value or an array with one value per jet
+        rescale_subjets (optional): Method to rescale the momentum of the subjets ('jec' or 'vec'), see get_splittings
+        rescale_vals (optional): Array of size N of the values used in subjet scaling
+        n_pfs (optional): Number of PF candidates of each jet (eg. jet1_extraInfo[:,6]), used to trim the padding
+
+        Returns : 
+        A tuple (subjets, subjet_offsets, splittings, split_offsets). 
+        subjets is an (n_subjets, 4) array of (pt, eta, phi, m), splittings an (n_splittings, 3) array of (subjet_idx, deltaR, kt)
+        where subjet_idx is the index of the subjet inside its own jet. 
+        The subjets of jet i are subjets[subjet_offsets[i]:subjet_offsets[i+1]] (same for the splittings).
+        """
+
+        n_jets = len(pf_cands)
+        num_excjets = np.broadcast_to(np.asarray(num_excjets, dtype = np.int64), (n_jets,))
+        cands, cand_offsets, good = self.preselect_pf_cands(pf_cands, n_pfs = n_pfs)
+
+        if(self.backend == "numba"):
+            from .LundClustering import cluster_batch
+
+            if(self.jetR < 0): R = 1000.0
+            else: R = self.jetR
+            subjets, subjet_counts, splittings, split_counts, total_pts = cluster_batch(np.ascontiguousarray(cands[:,:4]), cand_offsets, good, 
+                    np.ascontiguousarray(num_excjets), float(R), int(self.maxJets))
+
+        else:
+            subjets = []
+            splittings = []
+            subjet_counts = np.zeros(n_jets, dtype = np.int64)
+            split_counts = np.zeros(n_jets, dtype = np.int64)
+            total_pts = np.zeros(n_jets, dtype = np.float64)
+            for i in range(n_jets):
+                lo, hi = cand_offsets[i], cand_offsets[i+1]
+                subjet, split, total_pts[i] = self.cluster_jet(cands[lo:hi], num_excjets = num_excjets[i], good = good[lo:hi])
+                subjet_counts[i] = len(subjet)
+                split_counts[i] = len(split)
+                subjets.extend(subjet)
+                splittings.extend(split)
+
+            subjets = np.array(subjets, dtype = np.float64).reshape(-1, 4)
+            splittings = np.array(splittings, dtype = np.float64).reshape(-1, 3)
+
+        #Rescale subjet momenta
+        if(rescale_subjets == "jec"):
+            subjets[:,0] *= np.repeat(rescale_vals, subjet_counts)
+        elif(rescale_subjets == "vec"):
+            scale = np.asarray(rescale_vals, dtype = np.float64) / np.where(total_pts > 0., total_pts, 1.)
+            subjets[:,0] *= np.repeat(scale, subjet_counts)
+
+        return subjets, counts_to_offsets(subjet_counts), splittings, counts_to_offsets(split_counts)
+
+
+    def cluster_jet(self, pf_cands, num_excjets = -1, good = None):
+        """Recluster the PF candidates of a single jet (already cleaned of zero-padding) into subjets and get their splittings.
+        good (optional) : bool array of the candidates passing the pt (and charge) cuts, see preselect_pf_cands
+        Returns the (unscaled) subjets, the splittings and the pt of the sum of the subjets"""
+
+        if(good is None): _, _, good = self.preselect_pf_cands(pf_cands[np.newaxis])
+
+        pjs = []
+        for i, c in enumerate(pf_cands):
+            pj = fj.PseudoJet(c[0], c[1], c[2], c[3])
+            #keep track of which PF candidate each constituent comes from
+            pj.set_user_index(i)
+            pjs.append(pj)
 
         if(self.jetR < 0): R = 1000.0
         else: R = self.jetR
         #jet_algo = fj.cambridge_algorithm
         jet_algo = fj.kt_algorithm
-        jet_def = fj.JetDefinition(jet_algo, R)
+        jet_def = self.get_jet_def(jet_algo, R)
         cs = fj.ClusterSequence(pjs, jet_def)
         if(num_excjets < 0):
             js = fj.sorted_by_pt(cs.inclusive_jets())
@@ -190,32 +474,25 @@ class LundReweighter():
                 js_new = []
                 clust_seqs = []
                 for i, j in enumerate(js):
-                    CA_jet_def = fj.JetDefinition(fj.cambridge_algorithm, CA_R)
                     constituents = j.validated_cs().constituents(j)
 
                     cs_CA = []
                     for c in constituents:
                         #apply a cut on the constituents
-                        if(c.pt() > self.pf_pt_min):
-                            if(self.charge_only):
-                                pf = find_matching_pf(pfs_cut, c)
-                                if(pf is None):
-                                    print("NO match!")
-                                    print(c)
-                                    print(pfs)
-                                    exit(1)
-                                #4th entry is PUPPI weight, 5th entry is charge of PFCand
-                                eps = 1e-4
-                                if(pf is not None and abs(pf[5] ) > eps):
-                                    cs_CA.append(c)
-                            else:
-                                cs_CA.append(c)
+                        if(good[c.user_index()]):
+                            cs_CA.append(c)
+                            #only need to know whether any constituent passes
+                            if(self.reuse_clustering and len(cs_CA) > 0): break
 
                     if(len(cs_CA) > 0):
-                        CA_cs = fj.ClusterSequence(cs_CA, CA_jet_def)
-                        CA_jet = fj.sorted_by_pt(CA_cs.inclusive_jets())
                         js_new.append(j)
-                        clust_seqs.append(CA_cs) #prevent from going out of scope
+                        #the splittings are taken from the kt clustering, the CA reclustering of the subjet 
+                        #is only done in the old (non reuse_clustering) mode
+                        if(not self.reuse_clustering):
+                            CA_jet_def = fj.JetDefinition(fj.cambridge_algorithm, CA_R)
+                            CA_cs = fj.ClusterSequence(cs_CA, CA_jet_def)
+                            CA_jet = fj.sorted_by_pt(CA_cs.inclusive_jets())
+                            clust_seqs.append(CA_cs) #prevent from going out of scope
 
                 js = js_new
 
@@ -243,18 +520,8 @@ class LundReweighter():
                     pseudojet = j1
                 else:
                     break
-    
 
-        #Rescale subjet momenta
-        if(rescale_subjets == "jec"):
-            for i in range(len(subjets)):
-                subjets[i][0] *= rescale_val
-        elif(rescale_subjets == "vec"):
-            rescale_val = rescale_val / total_jet.pt()
-            for i in range(len(subjets)):
-                subjets[i][0] *= rescale_val
-
-        return subjets, splittings
+        return subjets, splittings, total_jet.pt()
 
 
     def fill_lund_plane(self, h, pf_cands = None, subjets = None,  splittings = None, num_excjets = -1, weight = 1., subjet_idx = -1,
@@ -287,26 +554,55 @@ class LundReweighter():
                     else: h.Fill(np.log(self.dR/delta), np.log(kt), weights[h_idx])
         return subjets, splittings
     
+    def get_hist_binning(self, h):
+        """Bin edges (and whether they are uniform) of the three axes of a ratio histogram"""
+        key = id(h)
+        #keep a reference to the histogram so its id can't be reused
+        if(key not in self.hist_binnings): self.hist_binnings[key] = (h, [get_axis_binning(ax) for ax in (h.GetXaxis(), h.GetYaxis(), h.GetZaxis())])
+        return self.hist_binnings[key][1]
+
+    def get_lund_plane_bins(self, h, pt, dr, kt):
+        """Bin numbers along each axis of h of arrays of Lund plane coordinates, 
+        under/overflows are clamped to the first/last bin (same as h.FindBin + h.GetBinXYZ + clipping)"""
+        return [np.clip(find_bins(v, edges, uniform), 1, len(edges) - 1) for v, (edges, uniform) in zip((pt, dr, kt), self.get_hist_binning(h))]
+
+    def get_ratio_table(self, h):
+        """RatioTable (dense contents and errors, with the empty bin rule and clipping applied) of a ratio histogram"""
+        key = id(h)
+        if(key not in self.ratio_tables): self.ratio_tables[key] = (h, RatioTable.from_hist(h, min_rw = self.min_rw, max_rw = self.max_rw))
+        return self.ratio_tables[key][1]
+
+    def get_lund_plane_idxs_batch(self, h, subjets, subjet_offsets, splittings, split_offsets):
+        """LP bin indices of all the splittings of a batch of jets (flat arrays + offsets).
+        Returns the (x, y, z) bin arrays and the index of the jet of each splitting"""
+        pt, dr, kt, jet_idxs = get_lund_coords(subjets, subjet_offsets, splittings, split_offsets, dR = self.dR)
+        binx, biny, binz = self.get_lund_plane_bins(h, pt, dr, kt)
+        return binx, biny, binz, jet_idxs
+
     def get_lund_plane_idxs(self, h,  subjets = None,  splittings = None, subjet_idx = -1):
         """Get LP bin indices  for some splittings"""
-        no_idx = (len(subjets) == 1)
-        subjets_reshape = np.array(subjets).reshape(-1)
+        subjets = np.array(subjets, dtype = np.float64).reshape(-1, 4)
+        splittings = np.array(splittings, dtype = np.float64).reshape(-1, 3)
+        pt, dr, kt, _ = get_lund_coords(subjets, np.array([0, len(subjets)]), splittings, np.array([0, len(splittings)]), dR = self.dR, 
+                subjet_idx = subjet_idx)
+        binx, biny, binz = self.get_lund_plane_bins(h, pt, dr, kt)
+        return list(zip(binx.tolist(), biny.tolist(), binz.tolist()))
 
-        idxs = []
 
-        binx,biny,binz = array('i', [0]), array('i', [0]), array('i', [0])
-        xmax, ymax, zmax = h.GetNbinsX(), h.GetNbinsY(),h.GetNbinsZ()
-        for jet_i, delta, kt in splittings:
-            if(subjet_idx >= 0 and jet_i != subjet_idx): continue
-            jet_int = int(np.round(jet_i))
-            jet_pt = subjets_reshape[0] if no_idx else subjets_reshape[jet_int*4]
-            if(delta > 0. and kt > 0.):
-                bin_idx = h.FindBin(jet_pt, np.log(self.dR/delta), np.log(kt))
 
-                h.GetBinXYZ(bin_idx, binx, biny, binz)
-                idxs.append((int(np.clip(binx[0], 1, xmax)), int(np.clip(biny[0], 1, ymax)), int(np.clip(binz[0], 1, zmax))))
-        return idxs
+    def get_pt_extrap_func(self, j, k, sys_str = ""):
+        """pt extrapolation function of Lund plane bin (j,k)"""
+        f_str = "func_%s%i_%i" % (sys_str, j,k)
+        if(f_str not in self.func_dict.keys()): self.func_dict[f_str] = self.pt_extrap_dir.Get(f_str)
+        return self.func_dict[f_str]
 
+    def get_pt_extrap_table(self, n_dR, n_kt, sys_str = ""):
+        """PtExtrapTable (coefficient tensor) of the pt extrapolation functions of a sys variation, built once"""
+        key = (sys_str, n_dR, n_kt)
+        if(key not in self.pt_extrap_tables):
+            get_func = lambda j, k: self.get_pt_extrap_func(j, k, sys_str)
+            self.pt_extrap_tables[key] = PtExtrapTable.from_funcs(get_func, n_dR, n_kt, min_rw = self.min_rw, max_rw = self.max_rw)
+        return self.pt_extrap_tables[key]
 
 
     def reweight_pt_extrap(self,  subjet_pt, lp_idxs, rw, smeared_rw, pt_smeared_rw, pt_rand_noise = None, sys_str = ""):
@@ -315,12 +611,7 @@ class LundReweighter():
 
         for (i,j,k) in lp_idxs:
 
-            f_str = "func_%s%i_%i" % (sys_str, j,k)
-            if(f_str in self.func_dict.keys()):
-                f = self.func_dict[f_str]
-            else:
-                f = self.pt_extrap_dir.Get(f_str)
-                self.func_dict[f_str] = f
+            f = self.get_pt_extrap_func(j, k, sys_str)
             #val = f.Eval(subjet_pt)
             val = f.Eval(1./subjet_pt)
             val = np.clip(val, self.min_rw, self.max_rw)
@@ -437,6 +728,75 @@ class LundReweighter():
         return rw, smeared_rw, pt_smeared_rw
 
 
+    def get_evaluator(self, h_rw, sys_str = ""):
+        """LundWeightEvaluator of h_rw and the pt extrapolation fits of sys_str, built from the cached tables"""
+        table = self.get_ratio_table(h_rw)
+        pt_tables = None
+        if(self.pt_extrap_dir is not None and 'bquark' not in sys_str): pt_tables = {sys_str : self.get_pt_extrap_table(*table.vals.shape[1:], sys_str = sys_str)}
+        return LundWeightEvaluator(table, pt_tables, pt_extrap_val = self.pt_extrap_val, dR = self.dR)
+
+    def compile(self, h_ratio, pt_extrap_dir = None, sys_strs = ("",)):
+        """Snapshot a ratio histogram and its pt extrapolation fits (those of each sys_str, read from pt_extrap_dir, 
+        by default the one of this LundReweighter) into a LundWeightEvaluator : plain numpy arrays with the same 
+        reweight_lund_plane semantics, which can be pickled and used in worker processes without ROOT"""
+        table = RatioTable.from_hist(h_ratio, min_rw = self.min_rw, max_rw = self.max_rw)
+        if(pt_extrap_dir is None): pt_extrap_dir = self.pt_extrap_dir
+        pt_tables = dict()
+        if(pt_extrap_dir is not None):
+            for sys_str in sys_strs:
+                get_func = lambda j, k: pt_extrap_dir.Get("func_%s%i_%i" % (sys_str, j, k))
+                pt_tables[sys_str] = PtExtrapTable.from_funcs(get_func, *table.vals.shape[1:], min_rw = self.min_rw, max_rw = self.max_rw)
+        return LundWeightEvaluator(table, pt_tables, pt_extrap_val = self.pt_extrap_val, dR = self.dR)
+
+    def get_splitting_vals(self, h_rw, pt, dr, kt, sys_str = "", bins = None):
+        """Bins and (clipped) reweighting factor of some splittings, from the RatioTable of h_rw or, for splittings of subjets above 
+        pt_extrap_val, from the pt extrapolation fits, evaluated all at once from their coefficients (PtExtrapTable).
+        bins (optional) : already computed bins of the splittings (for a ratio with the same binning)
+        Returns (vals, (binx, biny, binz), mask of the splittings using the pt extrapolation, PtExtrapTable or None)"""
+        return self.get_evaluator(h_rw, sys_str).get_splitting_vals(pt, dr, kt, sys_str = sys_str, bins = bins)
+
+    def reweight_lund_plane_batch(self, h_rw, subjets, subjet_offsets, splittings, split_offsets, rand_noise = None, pt_rand_noise = None, sys_str = ""):
+        """Reweighting factors (as reweight_lund_plane) of a whole batch of jets (flat arrays + offsets, see get_splittings_batch). 
+        The ratio of all the splittings is looked up at once in the RatioTable of h_rw and multiplied per jet, 
+        splittings of subjets above pt_extrap_val use the pt extrapolation fits, evaluated all at once from their coefficients (PtExtrapTable).
+        The statistical toys are computed for all jets and toys at once as exp(A @ log(r_toys)), with A the sparse (jets x bins) 
+        occupancy matrix of the splittings that use the ratio directly.
+
+        Returns : (weights (n_jets), stat. toy weights (n_jets, n_toys) or None, pt extrapolation toy weights (n_jets, n_pt_toys) or None)"""
+
+        return self.get_evaluator(h_rw, sys_str).reweight_lund_plane_batch(subjets, subjet_offsets, splittings, split_offsets, 
+                rand_noise = rand_noise, pt_rand_noise = pt_rand_noise, sys_str = sys_str)
+
+
+    def reweight_lund_plane_multi(self, h_rws, subjets, subjet_offsets, splittings, split_offsets, sys_strs = None, subjet_masks = None):
+        """Nominal reweighting factors of a batch of jets (flat arrays + offsets) for several ratios at once (eg. nominal, sys up/down, b/light),
+        the Lund plane coordinates of the splittings are only computed once.
+        sys_strs (optional) : sys_str of each ratio (selects the pt extrapolation fits, 'bquark' does not use them)
+        subjet_masks (optional) : for each ratio, None or a mask of the (flat) subjets to reweight (eg. those matched to b quarks,
+                                  see get_quark_matched_subjets), the splittings of the other subjets are ignored 
+
+        Returns an (n_jets, n_ratios) array of weights"""
+
+        n_jets = len(subjet_offsets) - 1
+        if(sys_strs is None): sys_strs = [""] * len(h_rws)
+        if(subjet_masks is None): subjet_masks = [None] * len(h_rws)
+        pt, dr, kt, jet_idxs, subjet_idxs = get_lund_coords(subjets, subjet_offsets, splittings, split_offsets, dR = self.dR, return_subjet_idxs = True)
+
+        weights = np.ones((n_jets, len(h_rws)))
+        edges = bins = None
+        for n, (h_rw, sys_str, subjet_mask) in enumerate(zip(h_rws, sys_strs, subjet_masks)):
+            #ratios with the same binning share the bin lookup
+            table = self.get_ratio_table(h_rw)
+            if(edges is None or not all(e.shape == e_ref.shape and np.array_equal(e, e_ref) for e, e_ref in zip(table.edges, edges))):
+                edges, bins = table.edges, None
+            vals, bins, _, _ = self.get_splitting_vals(h_rw, pt, dr, kt, sys_str = sys_str, bins = bins)
+            if(subjet_mask is None): weights[:, n] = segment_prod(vals, jet_idxs, n_jets)
+            else:
+                keep = np.asarray(subjet_mask, dtype = bool)[subjet_idxs]
+                weights[:, n] = segment_prod(vals[keep], jet_idxs[keep], n_jets)
+        return weights
+
+
     def make_LP_ratio(self, h_data, h_bkg, h_mc,  h_data_subjet_pt = None, h_bkg_subjet_pt = None, h_mc_subjet_pt = None, pt_bins = None, outdir = "", save_plots = False):
         """ Function to construct data/MC LP ratio"""
 
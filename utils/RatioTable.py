@@ -0,0 +1,214 @@
+""" ROOT-free copy of a data/MC Lund plane ratio histogram used to compute the weights of whole batches of jets at once.
+The empty bin rule and the clipping of LundReweighter.reweight are applied once when the table is built.
+The splittings of a batch can be represented as a sparse (n_jets x n_bins) occupancy matrix A, so that the weights of all jets
+for many variations of the ratio r (eg. statistical toys) are exp(A @ log(r)), a single sparse x dense product.
+LundWeightEvaluator bundles a RatioTable and the PtExtrapTables of its pt extrapolation fits into a plain numpy (picklable) 
+object that computes the weights without ROOT, eg. in worker processes. """
+
+import numpy as np
+import scipy.sparse
+from .LundPlaneHist import get_axis_binning, find_bins, get_lund_coords
+
+
+def segment_prod(vals, jet_idxs, n_jets):
+    """Product of the values belonging to each jet (jet_idxs sorted), jets without any value get 1.
+    Values are multiplied in order, as in a loop doing rw *= val"""
+    counts = np.bincount(jet_idxs, minlength = n_jets)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    out = np.ones((n_jets,) + vals.shape[1:], dtype = np.float64)
+    filled = counts > 0
+    if(np.any(filled)): out[filled] = np.multiply.reduceat(vals, starts[filled], axis = 0)
+    return out
+
+
+class RatioTable():
+    """Dense content and error arrays (n_pt, n_dR, n_kt) of a ratio histogram.
+    Empty bins (content and error <= 1e-4) are set to 1 +/- 1 and contents are clipped to [min_rw, max_rw]"""
+
+    def __init__(self, content, error, edges, uniform = (False, False, False), min_rw = 0.2, max_rw = 5.):
+        content = np.asarray(content, dtype = np.float64)
+        error = np.asarray(error, dtype = np.float64)
+        empty = (content <= 1e-4) & (error <= 1e-4)
+        self.vals = np.clip(np.where(empty, 1.0, content), min_rw, max_rw)
+        self.errs = np.where(empty, 1.0, error)
+        self.edges = [np.asarray(e, dtype = np.float64) for e in edges]
+        self.uniform = tuple(uniform)
+        self.min_rw = min_rw
+        self.max_rw = max_rw
+
+    @classmethod
+    def from_hist(cls, h, min_rw = 0.2, max_rw = 5.):
+        """Read the contents and errors of a ROOT TH3 (only once, rather than for each splitting)"""
+        binnings = [get_axis_binning(ax) for ax in (h.GetXaxis(), h.GetYaxis(), h.GetZaxis())]
+        shape = tuple(len(b[0]) - 1 for b in binnings)
+        content = np.zeros(shape)
+        error = np.zeros(shape)
+        for i, j, k in np.ndindex(*shape):
+            content[i,j,k] = h.GetBinContent(i+1, j+1, k+1)
+            error[i,j,k] = h.GetBinError(i+1, j+1, k+1)
+        return cls(content, error, [b[0] for b in binnings], uniform = [b[1] for b in binnings], min_rw = min_rw, max_rw = max_rw)
+
+    def find_bins(self, pt, dr, kt):
+        """Bin numbers (starting at 1, as ROOT) along each axis, under/overflows are clamped to the first/last bin"""
+        return [np.clip(find_bins(v, e, u), 1, len(e) - 1) for v, e, u in zip((pt, dr, kt), self.edges, self.uniform)]
+
+    def get_vals(self, binx, biny, binz):
+        return self.vals[binx - 1, biny - 1, binz - 1]
+
+    def get_errs(self, binx, biny, binz):
+        return self.errs[binx - 1, biny - 1, binz - 1]
+
+    def jet_weights(self, binx, biny, binz, jet_idxs, n_jets):
+        """Weight of each of n_jets jets, the product of the (clipped) ratio of the bins of its splittings"""
+        return segment_prod(self.get_vals(binx, biny, binz), jet_idxs, n_jets)
+
+    def flat_bins(self, binx, biny, binz):
+        """Index of bins (starting at 1 along each axis) in the flattened (n_pt * n_dR * n_kt) table"""
+        return np.ravel_multi_index((binx - 1, biny - 1, binz - 1), self.vals.shape)
+
+    def occupancy(self, binx, biny, binz, jet_idxs, n_jets):
+        """Sparse CSR matrix (n_jets x n_bins) of the number of splittings of each jet in each bin"""
+        n_bins = self.vals.size
+        return scipy.sparse.csr_matrix((np.ones(len(jet_idxs)), (jet_idxs, self.flat_bins(binx, biny, binz))), shape = (n_jets, n_bins))
+
+    def toy_log_vals(self, rand_noise):
+        """log of the ratio of each bin for each statistical toy, (n_bins, n_toys). 
+        rand_noise : (n_toys, n_pt, n_dR, n_kt) std normal noise, each bin of a toy is smeared by noise * error and clipped"""
+        rand_noise = np.asarray(rand_noise).reshape(-1, self.vals.size)
+        smeared = np.clip(self.vals.reshape(1, -1) + rand_noise * self.errs.reshape(1, -1), self.min_rw, self.max_rw)
+        return np.ascontiguousarray(np.log(smeared).T)
+
+    def toy_weights(self, occupancy, rand_noise, toy_chunk = 256):
+        """Weight of each jet (rows of occupancy) for each statistical toy, (n_jets, n_toys).
+        Toys are done in chunks of toy_chunk, so only the noise of one chunk is needed at once (see ToyNoise)"""
+        n_toys = len(rand_noise)
+        out = np.empty((occupancy.shape[0], n_toys))
+        for start in range(0, n_toys, toy_chunk):
+            stop = min(start + toy_chunk, n_toys)
+            out[:, start:stop] = np.exp(occupancy @ self.toy_log_vals(rand_noise[start:stop]))
+        return out
+
+
+
+class PtExtrapTable():
+    """Polynomial (in 1/pt) pt extrapolation fits of each (dR, kt) Lund plane bin, as a coefficient tensor (n_dR, n_kt, max_order+1)
+    and the tensor of their errors (both zero-padded for fits of lower order). has_func flags the bins with a fit"""
+
+    def __init__(self, coefs, errs, has_func, min_rw = 0.2, max_rw = 5.):
+        self.coefs = np.asarray(coefs, dtype = np.float64)
+        self.errs = np.asarray(errs, dtype = np.float64)
+        self.has_func = np.asarray(has_func, dtype = bool)
+        self.min_rw = min_rw
+        self.max_rw = max_rw
+
+    @classmethod
+    def from_funcs(cls, get_func, n_dR, n_kt, min_rw = 0.2, max_rw = 5.):
+        """Read the parameters of the fits once. get_func(j,k) returns the TF1 of bin (j,k) (starting at 1), or None if there is no fit"""
+        funcs = dict()
+        for j in range(1, n_dR + 1):
+            for k in range(1, n_kt + 1):
+                f = get_func(j, k)
+                if(f): funcs[(j,k)] = f
+        n_par = max([f.GetNpar() for f in funcs.values()], default = 1)
+
+        coefs = np.zeros((n_dR, n_kt, n_par))
+        errs = np.zeros((n_dR, n_kt, n_par))
+        has_func = np.zeros((n_dR, n_kt), dtype = bool)
+        for (j,k), f in funcs.items():
+            has_func[j-1, k-1] = True
+            for p in range(f.GetNpar()):
+                coefs[j-1, k-1, p] = f.GetParameter(p)
+                errs[j-1, k-1, p] = f.GetParError(p)
+        return cls(coefs, errs, has_func, min_rw = min_rw, max_rw = max_rw)
+
+    @staticmethod
+    def horner(coefs, x):
+        """Evaluate polynomials with coefficients (..., n_par) (increasing order) at x (broadcastable to coefs[..., 0])"""
+        val = coefs[..., -1]
+        for p in range(coefs.shape[-1] - 2, -1, -1): val = val * x + coefs[..., p]
+        return val
+
+    def eval(self, subjet_pts, biny, binz):
+        """(Clipped) value of the fits for some splittings, given the pt of their subjet and their (dR, kt) bins (starting at 1)"""
+        return np.clip(self.horner(self.coefs[biny - 1, binz - 1], 1. / subjet_pts), self.min_rw, self.max_rw)
+
+    def eval_toys(self, subjet_pts, biny, binz, pt_rand_noise):
+        """(Clipped) value of the fits for some splittings for each toy of pt_rand_noise (n_toys, n_dR, n_kt, >= n_par),
+        each parameter of a toy is smeared by noise * error. Returns an (n_splittings, n_toys) array"""
+        n_par = self.coefs.shape[-1]
+        #only the noise of the needed bins is looked up (or generated, for a ToyNoise)
+        if(isinstance(pt_rand_noise, list)): pt_rand_noise = np.asarray(pt_rand_noise)
+        noise = np.moveaxis(pt_rand_noise[:, biny - 1, binz - 1, :n_par], 0, 1)
+        coefs = self.coefs[biny - 1, binz - 1][:, np.newaxis] + self.errs[biny - 1, binz - 1][:, np.newaxis] * noise
+        return np.clip(self.horner(coefs, 1. / subjet_pts[:, np.newaxis]), self.min_rw, self.max_rw)
+
+
+
+class LundWeightEvaluator():
+    """ROOT-free snapshot of a ratio (RatioTable) and of its pt extrapolation fits (PtExtrapTable for each sys_str), 
+    with the same semantics as LundReweighter.reweight_lund_plane. Only holds numpy arrays, so it can be pickled and sent to worker processes.
+    Built with LundReweighter.compile"""
+
+    def __init__(self, table, pt_tables = None, pt_extrap_val = 350., dR = 0.8):
+        self.table = table
+        self.pt_tables = dict(pt_tables) if pt_tables is not None else dict()
+        self.pt_extrap_val = pt_extrap_val
+        self.dR = dR
+
+    def get_pt_table(self, sys_str = ""):
+        """PtExtrapTable used for a sys_str (None if there is no pt extrapolation)"""
+        if(len(self.pt_tables) == 0 or 'bquark' in sys_str): return None
+        if(sys_str not in self.pt_tables): 
+            raise ValueError("No pt extrapolation fits for sys_str '%s' (compiled for %s)" % (sys_str, list(self.pt_tables.keys())))
+        return self.pt_tables[sys_str]
+
+    def get_splitting_vals(self, pt, dr, kt, sys_str = "", bins = None):
+        """Bins and (clipped) reweighting factor of some splittings, from the ratio or, for splittings of subjets above 
+        pt_extrap_val, from the pt extrapolation fits.
+        bins (optional) : already computed bins of the splittings (for a ratio with the same binning)
+        Returns (vals, (binx, biny, binz), mask of the splittings using the pt extrapolation, PtExtrapTable or None)"""
+        binx, biny, binz = self.table.find_bins(pt, dr, kt) if bins is None else bins
+        vals = self.table.get_vals(binx, biny, binz)
+
+        pt_table = self.get_pt_table(sys_str)
+        extrap = np.zeros(len(pt), dtype = bool)
+        if(pt_table is not None):
+            #bins without a fit use the ratio directly
+            extrap = (pt >= self.pt_extrap_val) & pt_table.has_func[biny - 1, binz - 1]
+            vals[extrap] = pt_table.eval(pt[extrap], biny[extrap], binz[extrap])
+        return vals, (binx, biny, binz), extrap, pt_table
+
+    def reweight_lund_plane_batch(self, subjets, subjet_offsets, splittings, split_offsets, rand_noise = None, pt_rand_noise = None, sys_str = ""):
+        """Reweighting factors of a whole batch of jets (flat arrays + offsets), see LundReweighter.reweight_lund_plane_batch.
+
+        Returns : (weights (n_jets), stat. toy weights (n_jets, n_toys) or None, pt extrapolation toy weights (n_jets, n_pt_toys) or None)"""
+
+        n_jets = len(subjet_offsets) - 1
+        pt, dr, kt, jet_idxs = get_lund_coords(subjets, subjet_offsets, splittings, split_offsets, dR = self.dR)
+        vals, (binx, biny, binz), extrap, pt_table = self.get_splitting_vals(pt, dr, kt, sys_str = sys_str)
+        rw = segment_prod(vals, jet_idxs, n_jets)
+
+        smeared_rw = pt_smeared_rw = None
+        direct = ~extrap
+        if(rand_noise is not None):
+            #splittings using the pt extrapolation keep their nominal value
+            A = self.table.occupancy(binx[direct], biny[direct], binz[direct], jet_idxs[direct], n_jets)
+            smeared_rw = self.table.toy_weights(A, rand_noise) * segment_prod(vals[extrap], jet_idxs[extrap], n_jets)[:, np.newaxis]
+
+        if(pt_rand_noise is not None):
+            if(pt_table is not None): pt_toy_vals = pt_table.eval_toys(pt[extrap], biny[extrap], binz[extrap], pt_rand_noise)
+            else: pt_toy_vals = np.zeros((0, pt_rand_noise.shape[0]))
+            pt_smeared_rw = segment_prod(pt_toy_vals, jet_idxs[extrap], n_jets) * segment_prod(vals[direct], jet_idxs[direct], n_jets)[:, np.newaxis]
+
+        return rw, smeared_rw, pt_smeared_rw
+
+    def reweight_lund_plane(self, subjets, splittings, rand_noise = None, pt_rand_noise = None, sys_str = ""):
+        """Reweighting factor of a single jet from its subjets (pt, eta, phi, m) and splittings (subjet_idx, deltaR, kt).
+        Returns (weight, stat. toy weights or None, pt extrapolation toy weights or None), as LundReweighter.reweight_lund_plane"""
+        subjets = np.asarray(subjets, dtype = np.float64).reshape(-1, 4)
+        splittings = np.asarray(splittings, dtype = np.float64).reshape(-1, 3)
+        rw, smeared_rw, pt_smeared_rw = self.reweight_lund_plane_batch(subjets, np.array([0, len(subjets)]), splittings, np.array([0, len(splittings)]), 
+                rand_noise = rand_noise, pt_rand_noise = pt_rand_noise, sys_str = sys_str)
+        if(smeared_rw is not None): smeared_rw = smeared_rw[0]
+        if(pt_smeared_rw is not None): pt_smeared_rw = pt_smeared_rw[0]
+        return rw[0], smeared_rw, pt_smeared_rw
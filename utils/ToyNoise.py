@@ -0,0 +1,76 @@
+""" Counter-based std normal noise for the statistical and pt extrapolation toys.
+Each deviate is computed from the Philox4x32-10 block cipher applied to the counter (bin, toy, stream) with the seed as key,
+so the noise of a (toy, bin) does not depend on which other toys or bins are generated, nor on the batch, job or process.
+Only the requested entries are ever computed, so no (nToys, nX, nY, nZ) array has to be kept around or shipped to workers. """
+
+import numpy as np
+
+PHILOX_M0 = np.uint64(0xD2511F53)
+PHILOX_M1 = np.uint64(0xCD9E8D57)
+PHILOX_W0 = np.uint32(0x9E3779B9)
+PHILOX_W1 = np.uint32(0xBB67AE85)
+MASK32 = np.uint64(0xFFFFFFFF)
+
+
+def philox4x32(c0, c1, c2, c3, k0, k1, rounds = 10):
+    """Vectorized Philox4x32 (Salmon et al., 'Parallel random numbers: as easy as 1, 2, 3') of arrays of uint32 counters
+    (c0, c1, c2, c3) with the key (k0, k1). Returns the four uint32 output words"""
+    c0, c1, c2, c3 = [np.asarray(c, dtype = np.uint32) for c in (c0, c1, c2, c3)]
+    k0, k1 = np.uint32(k0), np.uint32(k1)
+    with np.errstate(over = 'ignore'):
+        for r in range(rounds):
+            p0 = PHILOX_M0 * c0.astype(np.uint64)
+            p1 = PHILOX_M1 * c2.astype(np.uint64)
+            hi0, lo0 = (p0 >> np.uint64(32)).astype(np.uint32), (p0 & MASK32).astype(np.uint32)
+            hi1, lo1 = (p1 >> np.uint64(32)).astype(np.uint32), (p1 & MASK32).astype(np.uint32)
+            c0, c1, c2, c3 = hi1 ^ c1 ^ k0, lo1, hi0 ^ c3 ^ k1, lo0
+            k0, k1 = k0 + PHILOX_W0, k1 + PHILOX_W1
+    return c0, c1, c2, c3
+
+
+class ToyNoise():
+    """Std normal noise of shape (n_toys, ...) (eg. rand_noise (nToys, nX, nY, nZ) or pt_rand_noise (nToys, nY, nZ, 3))
+    computed on demand. Behaves as a read-only numpy array : supports indexing (only the selected entries are generated),
+    .shape and np.asarray (which generates all of it).
+    Different streams (eg. 0 for the stat. toys and 1 for the pt extrapolation toys) with the same seed are independent"""
+
+    def __init__(self, n_toys, shape, seed = 123, stream = 0):
+        self.shape = (int(n_toys),) + tuple(int(n) for n in shape)
+        self.seed = int(seed)
+        self.stream = int(stream)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return "ToyNoise(n_toys = %i, shape = %s, seed = %i, stream = %i)" % (self.shape[0], self.shape[1:], self.seed, self.stream)
+
+    def deviates(self, toys, bins):
+        """Std normal deviates of some (toy, flat bin index) pairs (Box-Muller transform of the Philox output)"""
+        toys = np.asarray(toys, dtype = np.uint64)
+        bins = np.asarray(bins, dtype = np.uint64)
+        x0, x1, x2, x3 = philox4x32(bins & MASK32, bins >> np.uint64(32), toys, np.full(toys.shape, self.stream),
+                self.seed & 0xFFFFFFFF, (self.seed >> 32) & 0xFFFFFFFF)
+        #53 bit uniforms from pairs of words, u1 in (0, 1] to avoid log(0)
+        u1 = ((x0 >> np.uint32(5)).astype(np.float64) * 2.**26 + (x1 >> np.uint32(6)).astype(np.float64) + 1.) / 2.**53
+        u2 = ((x2 >> np.uint32(5)).astype(np.float64) * 2.**26 + (x3 >> np.uint32(6)).astype(np.float64)) / 2.**53
+        return np.sqrt(-2. * np.log(u1)) * np.cos(2. * np.pi * u2)
+
+    def __getitem__(self, key):
+        #index (zero memory) broadcast views of the coordinates along each axis, so only the selected entries are generated
+        coords = []
+        for axis, n in enumerate(self.shape):
+            ax_shape = [1] * self.ndim
+            ax_shape[axis] = n
+            coords.append(np.broadcast_to(np.arange(n).reshape(ax_shape), self.shape)[key])
+        toys = coords[0]
+        bins = np.ravel_multi_index(coords[1:], self.shape[1:]) if self.ndim > 1 else np.zeros_like(toys)
+        return self.deviates(toys, bins)
+
+    def __array__(self, dtype = None, copy = None):
+        out = self[...]
+        return out if dtype is None else out.astype(dtype)
@@ -1,4 +1,10 @@
 from .LundReweighter import *
+from .LundPlaneHist import *
+import os
+import multiprocessing
+from multiprocessing import shared_memory
+import concurrent.futures
+import collections
 
 ROOT.gROOT.SetBatch(True)
 ROOT.gStyle.SetOptStat(False)
@@ -80,6 +86,11 @@ def input_options():
     parser.add_argument("--job_idx", default=0, type = int, help="Max number of evts to reweight")
     parser.add_argument("-y", "--year", default=0, type = int, help="Year")
     parser.add_argument("--mode", default="",  help="Running mode")
+    parser.add_argument("--workers", default=1, type = int, help="Number of processes used to recluster the jets")
+    parser.add_argument("--backend", default="fastjet",  help="Clustering backend for the Lund Plane splittings ('fastjet' or 'numba')")
+    parser.add_argument("--checkpoint", default="",  help="File used to checkpoint (and resume) the Lund Plane fills")
+    parser.add_argument("--compression", default="",  help="Compression filter of the output weight datasets ('gzip' or 'lzf', none by default)")
+    parser.add_argument("--weight_format", default="float64",  help="Storage of the toy and sys weights : 'float64' (default), or the compact 'log32' / 'log16' (see encode_lund_weights)")
     return parser
 
 
@@ -102,15 +113,284 @@ def get_dists(q_eta_phis, subjets_eta_phis):
 
 
 
+def to_shared(arr):
+    """Copy an array into a new block of shared memory. Returns the memory block and a (name, shape, dtype) descriptor"""
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create = True, size = max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype = arr.dtype, buffer = shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+def attach_shared(desc):
+    """Attach to a block of shared memory created by to_shared. Returns the memory block and an array view of it"""
+    name, shape, dtype = desc
+    try:
+        shm = shared_memory.SharedMemory(name = name, track = False)
+    except TypeError:
+        #python < 3.13, workers share the resource tracker of the parent so attaching is harmless
+        shm = shared_memory.SharedMemory(name = name)
+    return shm, np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+
+
+def cluster_shard(LP_rw, arrs, start, stop, num_excjets, rescale_subjets):
+    pf_cands = arrs['pf_cands'][start:stop]
+    j_4vec = arrs['j_4vec'][start:stop]
+    rescale_vals = arrs['rescale_vals'][start:stop]
+    n_pfs = arrs['n_pfs'][start:stop] if 'n_pfs' in arrs else None
+    if('gen_eta_phi' in arrs):
+        return LP_rw.get_splittings_and_matching_batch(pf_cands, arrs['gen_eta_phi'][start:stop], j_4vec, rescale_subjets = rescale_subjets, 
+                rescale_vals = rescale_vals, n_pfs = n_pfs, gen_mask = arrs['gen_mask'][start:stop])
+    else:
+        out = LP_rw.get_splittings_batch(pf_cands, num_excjets = num_excjets, rescale_subjets = rescale_subjets, rescale_vals = rescale_vals, n_pfs = n_pfs)
+        return out + ([False] * len(pf_cands), [])
+
+def matched_splittings_worker(args):
+    """Recluster (and match) one shard of events in a worker process, the inputs are read from shared memory"""
+    config, descs, start, stop, num_excjets, rescale_subjets = args
+    LP_rw = LundReweighter(**config)
+
+    shms = []
+    arrs = dict()
+    for key, desc in descs.items():
+        shm, arrs[key] = attach_shared(desc)
+        shms.append(shm)
+
+    out = cluster_shard(LP_rw, arrs, start, stop, num_excjets, rescale_subjets)
+
+    del arrs
+    for shm in shms: shm.close()
+    return out
+
+
+def get_splittings_and_matching_parallel(LP_rw, pf_cands, j_4vec, gen_eta_phi = None, gen_mask = None, num_excjets = -1, rescale_subjets = "", 
+        rescale_vals = None, n_pfs = None, workers = 2):
+    """Shard the reclustering (and gen matching) of a block of jets across a pool of worker processes.
+    The input arrays are shared with the workers through shared memory rather than pickled. 
+    gen_eta_phi is a padded (N, n_gen, 2) array of the gen particles with gen_mask (N, n_gen) flagging the valid entries.
+    If no gen particles are given, jets are reclustered to num_excjets subjets without any matching. 
+
+    Returns the same outputs as LundReweighter.get_splittings_and_matching_batch, in event order."""
+
+    n_evts = len(pf_cands)
+    if(rescale_vals is None): rescale_vals = np.ones(n_evts)
+    arrays = {'pf_cands' : pf_cands, 'j_4vec' : j_4vec, 'rescale_vals' : np.asarray(rescale_vals, dtype = np.float64)}
+    if(n_pfs is not None): arrays['n_pfs'] = np.asarray(n_pfs)
+    if(gen_eta_phi is not None):
+        arrays['gen_eta_phi'] = gen_eta_phi
+        arrays['gen_mask'] = np.ones(gen_eta_phi.shape[:2], dtype = bool) if gen_mask is None else gen_mask
+
+    #a few shards per worker to balance the load
+    n_shards = max(1, min(n_evts, 4 * workers))
+    bounds = np.linspace(0, n_evts, n_shards + 1).astype(np.int64)
+
+    shms = []
+    try:
+        descs = dict()
+        for key, arr in arrays.items():
+            shm, descs[key] = to_shared(arr)
+            shms.append(shm)
+
+        tasks = [(LP_rw.clustering_config(), descs, bounds[i], bounds[i+1], num_excjets, rescale_subjets) for i in range(n_shards)]
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(matched_splittings_worker, tasks)
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+    subjets, subjet_offsets = concat_jagged([r[0] for r in results], [r[1] for r in results])
+    splittings, split_offsets = concat_jagged([r[2] for r in results], [r[3] for r in results])
+    bad_matches = []
+    dRs = []
+    for r in results:
+        bad_matches.extend(r[4])
+        dRs.extend(r[5])
+
+    return subjets, subjet_offsets, splittings, split_offsets, bad_matches, dRs
+
+
+def fill_LP_worker(args):
+    """Recluster one chunk of events of a dataset and fill their Lund plane (all variations and subjet pts)
+    into an empty partial LundPlaneHist, in a worker process"""
+    key, config, fname, cache_fname, dtype, evt_idxs, weights, h_LP, num_excjets, prefix, rescale_subjets = args
+    LP_rw = LundReweighter(**config)
+
+    f = h5py.File(fname, "r")
+    f_cache = h5py.File(cache_fname, "r") if cache_fname is not None else None
+    d = Dataset(f, dtype = dtype, f_cache = f_cache)
+    d.mask = np.zeros(d.mask.shape, dtype = bool)
+    d.mask[evt_idxs] = True
+    n_evts = len(evt_idxs)
+
+    cached = d.read_splittings_cache(LP_rw, prefix, num_excjets = num_excjets, rescale_subjets = rescale_subjets, matched = False,
+            min_evts = 0, max_evts = n_evts)
+    if(cached is not None): subjets, subjet_offsets, splittings, split_offsets, _ = cached
+    else: subjets, subjet_offsets, splittings, split_offsets = d.get_splittings(LP_rw, num_excjets = num_excjets,
+            min_evts = 0, max_evts = n_evts, rescale_subjets = rescale_subjets)
+
+    f.close()
+    if(f_cache is not None): f_cache.close()
+
+    h_LP.fill(subjets, subjet_offsets, splittings, split_offsets, weights, fill_subjet_pt = True)
+    return key, h_LP, subjets, subjet_offsets
+
+
+def get_LP_fill_tasks(LP_rw, fills, h_LPs, num_excjets, prefix, rescale_subjets, chunk_size, n_done = None):
+    """Split every dataset of fills into chunks of chunk_size (masked) events, skipping the first n_done[i][j] events of each dataset.
+    Yields the worker args of each chunk, in a fixed order, tagged by (fill idx, dataset idx, number of events done after this chunk)"""
+    config = LP_rw.clustering_config()
+    for i, (dsets, _, sys_variations) in enumerate(fills):
+        for j, d in enumerate(dsets):
+            evt_idxs = np.nonzero(d.mask)[0]
+            first = n_done[i][j] if n_done is not None else 0
+            if(first >= len(evt_idxs)): continue
+            weights = d.get_LP_weights(sys_variations)
+            cache_fname = None if d.f_cache is d.f else d.f_cache.filename
+            for start in range(first, len(evt_idxs), chunk_size):
+                stop = min(start + chunk_size, len(evt_idxs))
+                yield ((i, j, stop), config, d.f.filename, cache_fname, d.dtype, evt_idxs[start:stop], weights[:, start:stop],
+                        h_LPs[i].empty_like(), num_excjets, prefix, rescale_subjets)
+
+
+def LP_checkpoint_config(LP_rw, fills, h_LPs, num_excjets, prefix, rescale_subjets, chunk_size):
+    """Description of a parallel fill, a checkpoint can only be resumed by a fill with the same one"""
+    _, config = LP_rw.cache_hash(num_excjets, rescale_subjets, matched = False)
+    samples = [[(d.f.filename, int(d.dtype), hashlib.sha1(np.packbits(d.mask).tobytes()).hexdigest()) for d in dsets] for dsets, _, _ in fills]
+    n_vars = [h.n_var for h in h_LPs]
+    return json.dumps({'clustering' : config, 'prefix' : prefix, 'chunk_size' : chunk_size, 'samples' : samples, 'n_vars' : n_vars}, sort_keys = True)
+
+
+def fills_LP_hists(LP_rw, fills):
+    """Empty LundPlaneHist (with all the variations) for each fill of fill_LP_parallel"""
+    h_LPs = []
+    for dsets, h, sys_variations in fills:
+        if(isinstance(h, LundPlaneHist)):
+            h_LPs.append(h.empty_like())
+            continue
+        n_var = 1 + (len(sys_variations) if sys_variations is not None else 0)
+        var_names = ['nom'] + (list(sys_variations) if sys_variations is not None else [])
+        h_LPs.append(LundPlaneHist.from_hist(h, n_var = n_var, var_names = var_names, dR = LP_rw.dR))
+    return h_LPs
+
+
+def save_LP_checkpoint(fname, config, h_LPs, chunks, n_done):
+    """Save the partial histograms of a parallel fill, the subjets so far and the number of events done of each dataset.
+    Written to a temporary file first so that an interrupted write never corrupts the previous checkpoint"""
+    tmp_fname = fname + ".tmp"
+    with h5py.File(tmp_fname, "w") as f:
+        f.attrs['config'] = config
+        for i, h_LP in enumerate(h_LPs):
+            grp = f.create_group("fill_%i" % i)
+            for key in ('sumw', 'sumw2', 'subjet_pt_sumw', 'subjet_pt_sumw2'): grp.create_dataset(key, data = getattr(h_LP, key))
+            grp.attrs['entries'] = h_LP.entries
+            for j, d_chunks in enumerate(chunks[i]):
+                #merge the chunks so far to keep the number of chunks bounded
+                if(len(d_chunks) > 1): d_chunks[:] = [concat_jagged([c[0] for c in d_chunks], [c[1] for c in d_chunks])]
+                d_grp = grp.create_group("dset_%i" % j)
+                d_grp.attrs['n_done'] = n_done[i][j]
+                if(len(d_chunks) > 0):
+                    d_grp.create_dataset('subjets', data = d_chunks[0][0])
+                    d_grp.create_dataset('subjet_offsets', data = d_chunks[0][1])
+    os.replace(tmp_fname, fname)
+
+
+def load_LP_checkpoint(fname, config, h_LPs, chunks, n_done):
+    """Restore the state saved by save_LP_checkpoint into h_LPs, chunks and n_done.
+    Returns False (leaving them untouched) if there is no checkpoint or it was made by a different fill"""
+    if(not os.path.exists(fname)): return False
+    with h5py.File(fname, "r") as f:
+        if(f.attrs.get('config', "") != config):
+            print("Checkpoint %s was made with a different config, ignoring it" % fname)
+            return False
+        for i, h_LP in enumerate(h_LPs):
+            grp = f["fill_%i" % i]
+            for key in ('sumw', 'sumw2', 'subjet_pt_sumw', 'subjet_pt_sumw2'): setattr(h_LP, key, grp[key][()])
+            h_LP.entries = int(grp.attrs['entries'])
+            for j in range(len(chunks[i])):
+                d_grp = grp["dset_%i" % j]
+                n_done[i][j] = int(d_grp.attrs['n_done'])
+                if('subjets' in d_grp): chunks[i][j] = [(d_grp['subjets'][()], d_grp['subjet_offsets'][()])]
+    return True
+
+
+def fill_LP_parallel(LP_rw, fills, num_excjets = 2, prefix = "", rescale_subjets = "vec", workers = 2, chunk_size = 20000, 
+        checkpoint = None, checkpoint_every = 20):
+    """Map-reduce version of Dataset.fill_LP for several samples at once.
+    fills : list of (datasets, h, sys_variations), one for each histogram to fill (eg. data, signal and background), with h and
+            sys_variations as for Dataset.fill_LP (a ROOT TH3 and dict of TH3 or a LundPlaneHist and list of sys names).
+    Every dataset is split into chunks of chunk_size events which are reclustered and filled into partial LundPlaneHists
+    (including the subjet pt histograms) by a pool of worker processes (in this process if workers <= 1). 
+    The partials are merged in a fixed order (independent of the number of workers) and, for ROOT histograms, 
+    written to h and its variations at the end.
+
+    checkpoint : file where the merged partials and the number of events done of each dataset are saved every checkpoint_every chunks.
+                 If it already exists (from an interrupted run of the same fill), the fill resumes from it and gives identical histograms.
+                 It is removed once the fill is finished.
+
+    Returns, for each fill, the merged LundPlaneHist and the list of the subjets of each jet of each of its datasets (as fill_LP) """
+
+    h_LPs = fills_LP_hists(LP_rw, fills)
+    chunks = [[[] for d in dsets] for dsets, _, _ in fills]
+    n_done = [[0 for d in dsets] for dsets, _, _ in fills]
+
+    if(checkpoint is not None):
+        config = LP_checkpoint_config(LP_rw, fills, h_LPs, num_excjets, prefix, rescale_subjets, chunk_size)
+        if(load_LP_checkpoint(checkpoint, config, h_LPs, chunks, n_done)): print("Resuming Lund plane fill from %s" % checkpoint)
+
+    tasks = get_LP_fill_tasks(LP_rw, fills, h_LPs, num_excjets, prefix, rescale_subjets, chunk_size, n_done = n_done)
+
+    #imap returns the partials in the order of the tasks
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        partials = pool.imap(fill_LP_worker, tasks) if pool is not None else map(fill_LP_worker, tasks)
+        for n, ((i, j, stop), h_part, subjets, subjet_offsets) in enumerate(partials):
+            h_LPs[i].add(h_part)
+            chunks[i][j].append((subjets, subjet_offsets))
+            n_done[i][j] = stop
+            if(checkpoint is not None and (n + 1) % checkpoint_every == 0): save_LP_checkpoint(checkpoint, config, h_LPs, chunks, n_done)
+    finally:
+        if(pool is not None):
+            pool.terminate()
+            pool.join()
+
+    results = []
+    for i, (dsets, h, sys_variations) in enumerate(fills):
+        if(isinstance(h, LundPlaneHist)): h_LPs[i] = h.add(h_LPs[i])
+        else:
+            hists = [h] + ([sys_variations[sys] for sys in sys_variations] if sys_variations is not None else [])
+            for var, h_root in enumerate(hists): h_LPs[i].write_to_hist(h_root, var = var)
+
+        all_subjets = []
+        for d_chunks in chunks[i]:
+            if(len(d_chunks) == 0): subjets, subjet_offsets = np.zeros((0,4)), np.zeros(1, dtype = np.int64)
+            else: subjets, subjet_offsets = concat_jagged([c[0] for c in d_chunks], [c[1] for c in d_chunks])
+            subjets = split_jagged(subjets, subjet_offsets)
+            for idx in range(len(subjets)):
+                if(len(subjets[idx]) == 0): subjets[idx] = [[0,0,0,0]]
+            all_subjets.append(subjets)
+        results.append((h_LPs[i], all_subjets))
+
+    if(checkpoint is not None and os.path.exists(checkpoint)): os.remove(checkpoint)
+    return results
+
+
 def deltaR(v1, v2):
     dR = np.sqrt(np.square(v1[1] - v2[1]) + 
             np.square(ang_dist(v1[2], v2[2] )))
     return dR
 
+def h5_memmap(dset):
+    """Memory map an h5 dataset if it is stored contiguously (uncompressed), otherwise return the dataset itself (read lazily)"""
+    offset = dset.id.get_offset()
+    if(offset is None or dset.size == 0): return dset
+    return np.memmap(dset.file.filename, mode = 'r', dtype = dset.dtype, offset = offset, shape = dset.shape)
+
+
 class Dataset():
-    def __init__(self, f, is_data = False, label = "", color = "", jms_corr = 1.0, dtype = 0):
+    def __init__(self, f, is_data = False, label = "", color = "", jms_corr = 1.0, dtype = 0, f_cache = None):
 
         self.f = f
+        #file where saved subjets and splittings are read from / written to
+        self.f_cache = f if f_cache is None else f_cache
         self.is_data = is_data
 
         self.label = label
@@ -134,8 +414,14 @@ class Dataset():
     def apply_cut(self, cut):
         self.mask = self.mask & cut
     
-    def get_masked(self, key):
-        return self.f[key][()][self.mask]
+    def get_masked(self, key, min_evts = None, max_evts = None):
+        """Masked events of a dataset. If min_evts / max_evts are given, only the masked events min_evts:max_evts are returned
+        and only the block of the file spanned by them is read"""
+        if(min_evts is None and max_evts is None): return self.f[key][()][self.mask]
+        evt_idxs = np.nonzero(self.mask)[0][min_evts:max_evts]
+        if(len(evt_idxs) == 0): return self.f[key][0:0]
+        lo, hi = evt_idxs[0], evt_idxs[-1] + 1
+        return self.f[key][lo:hi][evt_idxs - lo]
 
     def apply_sys(self, sys_key):
         if(sys_key not in sys_weights_map.keys()): 
@@ -174,40 +460,52 @@ class Dataset():
 
 
 
-    def fill_LP(self, LP_rw, h, num_excjets = 2, prefix = "2prong", sys_variations = None, rescale_subjets = "vec"):
-
-
-        pf_cands = self.get_masked("jet1_PFCands").astype(np.float64)
-        splittings = subjets =  split = subjet = None
+    def fill_LP(self, LP_rw, h, num_excjets = 2, prefix = "2prong", sys_variations = None, rescale_subjets = "vec", fill_subjet_pt = False):
+        """Fill the Lund plane of this dataset into h, either a ROOT TH3 (with sys_variations a dict of sys name -> TH3 of the variation)
+        or a LundPlaneHist whose variations are the nominal followed by those of sys_variations (a list of sys names).
+        fill_subjet_pt : also fill the subjet pt histograms of the LundPlaneHist
+        Returns the subjets of each jet"""
 
+        cached = self.read_splittings_cache(LP_rw, prefix, num_excjets = num_excjets, rescale_subjets = rescale_subjets, matched = False)
+        if(cached is not None):
+            print("Found saved " + prefix + "_splittings")
+            subjets, subjet_offsets, splittings, split_offsets, _ = cached
+        else:
+            subjets, subjet_offsets, splittings, split_offsets = self.get_splittings(LP_rw, num_excjets = num_excjets, rescale_subjets = rescale_subjets)
 
 
-        jet_kinematics = self.get_masked("jet_kinematics")
-        nom_weights = self.get_weights()
+        hists = [h]
+        if(isinstance(sys_variations, dict)): hists += [sys_variations[sys] for sys in sys_variations]
+        weights = self.get_LP_weights(sys_variations)
 
-        rescale_vals = [1.] * len(pf_cands)
-        if(rescale_subjets == "jec"):
-            rescale_vals = self.get_masked("jet1_JME_vars")[:,-1]
-        elif(rescale_subjets == "vec"):
-            if(self.dtype ==1): 
-                if(which_j == 1): j_4vec = self.get_masked('jet_kinematics')[:,2:6].astype(np.float64)
-                else: j_4vec = self.get_masked('jet_kinematics')[:,6:10].astype(np.float64)
+        if(isinstance(h, LundPlaneHist) or h.GetDimension() == 3):
+            #fill all variations at once, only copy into the ROOT histograms at the end
+            h_LP = h if isinstance(h, LundPlaneHist) else LundPlaneHist.from_hist(h, n_var = len(hists), dR = LP_rw.dR)
+            h_LP.fill(subjets, subjet_offsets, splittings, split_offsets, weights, fill_subjet_pt = fill_subjet_pt)
+            if(not isinstance(h, LundPlaneHist)):
+                for i, h_root in enumerate(hists): h_LP.write_to_hist(h_root, var = i)
 
-            else:
-                j_4vec = self.get_masked('jet_kinematics')[:,:4].astype(np.float64)
+        subjets = split_jagged(subjets, subjet_offsets)
+        splittings = split_jagged(splittings, split_offsets)
+        for i in range(len(subjets)):
+            if(len(subjets[i]) == 0): subjets[i] = [[0,0,0,0]]
 
-            rescale_vals = j_4vec[:, 0]
+            if(not isinstance(h, LundPlaneHist) and h.GetDimension() != 3):
+                LP_rw.fill_lund_plane(hists, subjets = subjets[i], splittings = splittings[i], weight = weights[:,i])
 
+        return subjets
+            
 
-        hists = [h]
+    def get_LP_weights(self, sys_variations = None):
+        """Weights of each event used to fill the Lund plane, for the nominal followed by each of the sys_variations.
+        Returns an array of shape (1 + n_sys, N)"""
+        nom_weights = self.get_weights()
         weights = [nom_weights]
 
-        if(sys_variations is not None):
-
+        if(sys_variations is not None and len(sys_variations) > 0):
             all_sys_weights = self.get_masked('sys_weights')
 
-
-            for sys in sys_variations.keys():
+            for sys in sys_variations:
                 #don't vary ttbar norm at the same time
                 if(sys == 'bkg_norm_up'): weights_sys = nom_weights * (1. + self.norm_unc)
                 elif(sys == 'bkg_norm_down'): weights_sys = nom_weights  * (1. - self.norm_unc)
@@ -216,28 +514,119 @@ class Dataset():
                     weights_sys = nom_weights * all_sys_weights[:, sys_idx]
 
                 weights.append(weights_sys)
-                hists.append(sys_variations[sys])
 
+        return np.array(weights, dtype = np.float32)
 
-            #for idx,h in enumerate(hists):
-            #    h.Print()
-            #    print(weights[idx][:10])
 
+    def get_pf_cands(self, which_j = 1, min_evts = None, max_evts = None):
+        """PF candidates of jet which_j, with the zero-padding trimmed to the largest number of candidates of any of the jets.
+        Also returns the number of PF candidates of each jet (jet_extraInfo[:,6], None if not saved)"""
+        n_pfs = None
+        key = "jet%i_extraInfo" % which_j
+        if(key in self.f.keys() and self.f[key].shape[1] > 6): n_pfs = self.get_masked(key, min_evts, max_evts)[:, 6]
 
-        weights = np.array(weights, dtype = np.float32)
-        subjets = []
-        for i,pf_cand in enumerate(pf_cands):
-            if(splittings is not None):
-                split = splittings[i]
-                subjet = subjets[i]
+        pf_cands = self.get_masked("jet%i_PFCands" % which_j, min_evts, max_evts)
+        if(n_pfs is not None and len(n_pfs) > 0): pf_cands = pf_cands[:, :int(min(np.amax(n_pfs), pf_cands.shape[1]))]
+        return pf_cands.astype(np.float64), n_pfs
 
 
-            subjet, _ = LP_rw.fill_lund_plane(hists, pf_cands = pf_cand, subjets = subjet, splittings = split, 
-                    num_excjets = num_excjets, weight = weights[:,i], rescale_subjets = rescale_subjets, rescale_val = rescale_vals[i])
-            subjets.append(subjet)
+    def get_splittings(self, LP_rw, num_excjets = 2, min_evts = None, max_evts = None, rescale_subjets = "vec"):
+        """Recluster the (leading) jets into num_excjets subjets without any gen matching. Returns flat arrays, see LundReweighter.get_splittings_batch"""
+
+        pf_cands, n_pfs = self.get_pf_cands(1, min_evts, max_evts)
+        jet_kinematics = self.get_masked("jet_kinematics", min_evts, max_evts)
+
+        rescale_vals = np.ones(len(pf_cands))
+        if(rescale_subjets == "jec"):
+            rescale_vals = self.get_masked("jet1_JME_vars", min_evts, max_evts)[:,-1]
+        elif(rescale_subjets == "vec"):
+            if(self.dtype ==1): j_4vec = jet_kinematics[:,2:6].astype(np.float64)
+            else: j_4vec = jet_kinematics[:,:4].astype(np.float64)
+
+            rescale_vals = j_4vec[:, 0]
+
+        return LP_rw.get_splittings_batch(pf_cands, num_excjets = num_excjets, rescale_subjets = rescale_subjets, rescale_vals = rescale_vals, n_pfs = n_pfs)
+
+
+    def write_splittings_cache(self, LP_rw, prefix = "", num_excjets = 2, rescale_subjets = "vec", matched = True, batch_size = 5000, workers = 1):
+        """Recluster all the (masked) events and save their subjets and splittings to self.f_cache so that later 
+        calls of fill_LP / reweight_LP (with the same prefix and clustering config) can reuse them.
+        matched : Whether to use the gen-matched clustering of get_matched_splittings (as in reweight_LP) or 
+                  the plain clustering to num_excjets subjets of get_splittings (as in fill_LP)
+
+        Saved as a group 'prefix_splittings' of flat (ragged) subjets / splittings arrays with offsets over all events of the file, 
+        tagged with a hash of the clustering config."""
+
+        key = prefix + "_splittings"
+        if(key in self.f_cache.keys()): del self.f_cache[key]
+        grp = self.f_cache.create_group(key)
+        config_hash, config = LP_rw.cache_hash(num_excjets, rescale_subjets, matched)
+        grp.attrs['config_hash'] = config_hash
+        grp.attrs['config'] = config
+
+        all_subjets = []
+        all_splittings = []
+        n_file = self.f['jet_kinematics'].shape[0]
+        evt_idxs = np.nonzero(self.mask)[0]
+        subjet_counts = np.zeros(n_file, dtype = np.int64)
+        split_counts = np.zeros(n_file, dtype = np.int64)
+        bad_match = np.zeros(n_file, dtype = bool)
+        cached = np.zeros(n_file, dtype = bool)
+
+        for start in range(0, len(evt_idxs), batch_size):
+            stop = min(start + batch_size, len(evt_idxs))
+            if(matched):
+                subjets, subjet_offsets, splittings, split_offsets, bad_matches, _ = self.get_matched_splittings(LP_rw, num_excjets, 
+                        min_evts = start, max_evts = stop, rescale_subjets = rescale_subjets, workers = workers, flat = True)
+            else:
+                subjets, subjet_offsets, splittings, split_offsets = self.get_splittings(LP_rw, num_excjets, 
+                        min_evts = start, max_evts = stop, rescale_subjets = rescale_subjets)
+                bad_matches = False
+
+            all_subjets.append(subjets)
+            all_splittings.append(splittings.reshape(-1, 3))
+
+            idxs = evt_idxs[start:stop]
+            subjet_counts[idxs] = np.diff(subjet_offsets)
+            split_counts[idxs] = np.diff(split_offsets)
+            bad_match[idxs] = bad_matches
+            cached[idxs] = True
+
+        #contiguous (unchunked) storage so that they can be memory mapped when read back
+        grp.create_dataset('subjets', data = np.concatenate(all_subjets) if len(all_subjets) > 0 else np.zeros((0,4)))
+        grp.create_dataset('splittings', data = np.concatenate(all_splittings) if len(all_splittings) > 0 else np.zeros((0,3)))
+        grp.create_dataset('subjet_offsets', data = counts_to_offsets(subjet_counts))
+        grp.create_dataset('split_offsets', data = counts_to_offsets(split_counts))
+        grp.create_dataset('bad_match', data = bad_match)
+        grp.create_dataset('cached', data = cached)
+
+
+    def read_splittings_cache(self, LP_rw, prefix = "", num_excjets = 2, rescale_subjets = "vec", matched = True, min_evts = None, max_evts = None):
+        """Read back subjets and splittings saved by write_splittings_cache for the (masked) events min_evts:max_evts.
+        Returns None if nothing was saved for this clustering config or some of the events were not saved, otherwise
+        (subjets, subjet_offsets, splittings, split_offsets, bad_matches) """
+
+        key = prefix + "_splittings"
+        if(key not in self.f_cache.keys()): return None
+        grp = self.f_cache[key]
+        config_hash, _ = LP_rw.cache_hash(num_excjets, rescale_subjets, matched)
+        if(not isinstance(grp, h5py.Group) or grp.attrs.get('config_hash', "") != config_hash): return None
+
+        evt_idxs = np.nonzero(self.mask)[0][min_evts:max_evts]
+        if(not np.all(grp['cached'][()][evt_idxs])): return None
+
+        subjets, subjet_offsets = self.read_jagged(grp['subjets'], grp['subjet_offsets'][()], evt_idxs)
+        splittings, split_offsets = self.read_jagged(grp['splittings'], grp['split_offsets'][()], evt_idxs)
+        return subjets, subjet_offsets, splittings, split_offsets, grp['bad_match'][()][evt_idxs]
+
+    def read_jagged(self, dset, offsets, evt_idxs):
+        if(len(evt_idxs) == 0): return np.zeros((0,) + dset.shape[1:], dtype = dset.dtype), np.zeros(1, dtype = np.int64)
+        #only read the block of values spanned by the selected events
+        lo = offsets[evt_idxs[0]]
+        hi = offsets[evt_idxs[-1] + 1]
+        vals = np.asarray(h5_memmap(dset)[lo:hi])
+        return take_jagged(vals, offsets - lo, evt_idxs)
 
-        return subjets
-            
 
     def get_pt_response(self, gen_parts, subjets):
         deltaR_cut = 0.2
@@ -261,145 +650,192 @@ class Dataset():
 
 
 
-    def get_matched_splittings(self, LP_rw, num_excjets = 2, min_evts = None, max_evts = None, which_j =1, rescale_subjets = "vec"):
-
-
-        pf_cands = self.get_masked("jet%i_PFCands" % which_j).astype(np.float64)[min_evts:max_evts]
-        if(self.dtype ==1): 
-            if(which_j == 1): j_4vec = self.get_masked('jet_kinematics')[min_evts:max_evts][:,2:6].astype(np.float64)
-            else: j_4vec = self.get_masked('jet_kinematics')[min_evts:max_evts][:,6:10].astype(np.float64)
-
-        else:
-            j_4vec = self.get_masked('jet_kinematics')[min_evts:max_evts][:,:4].astype(np.float64)
-
-        rescale_vals = [1.] * len(j_4vec)
-        if(rescale_subjets == "jec"):
-            rescale_vals = self.get_masked("jet%i_JME_vars" % which_j)[min_evts:max_evts, 12]
-        elif(rescale_subjets == "vec"):
-            rescale_vals = j_4vec[:,0]
-
-
-        num_excjets_l = [num_excjets]*len(pf_cands)
-
-        if(num_excjets > 0 and self.dtype < 0): 
-            #No gen info
-            for i in range(len(pf_cands)):
-                subjet, split = LP_rw.get_splittings(pf_cands[i], num_excjets = num_excjets_l[i], rescale_subjets = rescale_subjets, rescale_val = rescale_vals[i])
-                subjets.append(subjet)
-                splittings.append(split)
-            return subjets, splittings, bad_match
+    def get_gen_parts(self, min_evts = None, max_evts = None):
+        """Gen particles (pt, eta, phi, pdg id) of CASE events, without the neutrinos, as a flat (n_gen, 4) array + (N+1) offsets.
+        Leptons are the particles with abs(pdg id) > 10"""
+        gen_parts = self.get_masked('gen_info', min_evts, max_evts)
+        gen_pdg_id = np.abs(gen_parts[:,:,3])
+        #neutrino pdg ids are 12,14,16
+        not_neutrinos = ((~np.isclose(gen_pdg_id, 12)) & (~np.isclose(gen_pdg_id, 14)) & (~np.isclose(gen_pdg_id, 16)))
+        return gen_parts[not_neutrinos], counts_to_offsets(np.sum(not_neutrinos, axis = -1))
 
+    def get_gen_eta_phi(self, min_evts = None, max_evts = None):
+        """(eta, phi) of the gen-level quarks (and leptons) used to match the subjets. 
+        Returns a padded (N, n_gen, 2) array and a mask of its valid entries (None if all are valid)"""
         if(self.dtype == 1): #CASE h5
-            gen_parts = self.get_masked('gen_info')[min_evts:max_evts]
-            n_evts = gen_parts.shape[0]
-            gen_parts_eta_phi_raw = gen_parts[:,:,1:3]
-            gen_pdg_id = np.abs(gen_parts[:,:,3])
-            #neutrino pdg ids are 12,14,16
-            is_lep = gen_pdg_id > 10
-            not_neutrinos = ((~np.isclose(gen_pdg_id, 12)) & (~np.isclose(gen_pdg_id, 14)) & (~np.isclose(gen_pdg_id, 16)))
-            
-            gen_parts_eta_phi = [gen_parts_eta_phi_raw[i][not_neutrinos[i]] for i in range(n_evts)]
-            #gen_parts_eta_phi = gen_parts_eta_phi[not_neutrinos].reshape(n_evts, -1, 2)
-            is_lep = is_lep[not_neutrinos]
-
+            gen_vals, gen_offsets = self.get_gen_parts(min_evts, max_evts)
+            gen_parts_eta_phi, gen_mask = pad_jagged(gen_vals[:,1:3], gen_offsets)
 
         else:#W or t matched MC
-            gen_parts = self.get_masked('gen_parts')[min_evts:max_evts]
+            gen_parts = self.get_masked('gen_parts', min_evts, max_evts)
             q1_eta_phi = gen_parts[:,18:20]
             q2_eta_phi = gen_parts[:,22:24]
             b_eta_phi = gen_parts[:,26:28]
             if(self.dtype == 2): gen_parts_eta_phi = np.stack([q1_eta_phi,q2_eta_phi], axis = 1)
             else: gen_parts_eta_phi = np.stack([q1_eta_phi, q2_eta_phi, b_eta_phi], axis = 1)
+            gen_mask = None
 
+        return gen_parts_eta_phi, gen_mask
 
-        subjets = []
-        splittings = []
-        bad_matches = []
-        dRs = []
-
-        for i in range(len(pf_cands)):
-            subjet, split, bad_match, deltaR = LP_rw.get_splittings_and_matching(pf_cands[i], gen_parts_eta_phi[i], j_4vec[i], rescale_subjets = rescale_subjets, rescale_val = rescale_vals[i])
+    def get_bquarks_eta_phi(self, min_evts = None, max_evts = None):
+        """(eta, phi) of the gen-level b quarks of each event as a flat array + offsets"""
+        if(self.dtype == 1): #CASE h5 saves all gen decays with pdg ID
+            B_ID = 5 
+            gen_vals, gen_offsets = self.get_gen_parts(min_evts, max_evts)
+            is_b = np.abs(gen_vals[:,3]) == B_ID
+            n_evts = len(gen_offsets) - 1
+            evt_idxs = np.repeat(np.arange(n_evts), np.diff(gen_offsets))
+            b_counts = np.bincount(evt_idxs[is_b], minlength = n_evts)
+            return gen_vals[is_b][:,1:3], counts_to_offsets(b_counts)
+        else: #ttbar MC saves in order
+            b_eta_phi = self.get_masked('gen_parts', min_evts, max_evts)[:,26:28]
+            return b_eta_phi, np.arange(len(b_eta_phi) + 1)
 
-            subjets.append(subjet)
-            splittings.append(split)
-            bad_matches.append(bad_match)
-            dRs.append(deltaR)
 
-        return subjets, splittings, bad_matches, dRs
 
+    def get_matched_splittings(self, LP_rw, num_excjets = 2, min_evts = None, max_evts = None, which_j =1, rescale_subjets = "vec", workers = 1, flat = False):
+        """Recluster jets and match their subjets to the gen-level quarks. 
+        With workers > 1 the events are sharded across a pool of processes (results are still returned in event order)
+        With flat = True, returns flat arrays + offsets (see LundReweighter.get_splittings_and_matching_batch) rather than per-jet lists"""
 
-    def reweight_LP(self, LP_rw, h_ratio, num_excjets = 2, min_evts = None, max_evts =None, prefix = "", 
-            rand_noise = None,  pt_rand_noise = None, sys_str = "", subjets = None, splittings = None, norm = True):
 
-        LP_weights = []
-        LP_smeared_weights = []
-        pt_smeared_weights = []
-        pf_cands = self.get_masked("jet1_PFCands").astype(np.float64)[min_evts:max_evts]
-        if('bquark' in sys_str): 
-            if(self.dtype == 1):
-                gen_parts = self.get_masked('gen_info')[min_evts:max_evts]
-            else: 
-                gen_parts = self.get_masked('gen_parts')[min_evts:max_evts]
+        pf_cands, n_pfs = self.get_pf_cands(which_j, min_evts, max_evts)
+        if(self.dtype ==1): 
+            if(which_j == 1): j_4vec = self.get_masked('jet_kinematics', min_evts, max_evts)[:,2:6].astype(np.float64)
+            else: j_4vec = self.get_masked('jet_kinematics', min_evts, max_evts)[:,6:10].astype(np.float64)
 
+        else:
+            j_4vec = self.get_masked('jet_kinematics', min_evts, max_evts)[:,:4].astype(np.float64)
 
+        rescale_vals = np.ones(len(j_4vec))
+        if(rescale_subjets == "jec"):
+            rescale_vals = self.get_masked("jet%i_JME_vars" % which_j, min_evts, max_evts)[:, 12]
+        elif(rescale_subjets == "vec"):
+            rescale_vals = j_4vec[:,0]
 
-        if(splittings is None):
-            print("Getting splittings")
-            if(prefix + "_splittings" in self.f.keys()):
-                print("Found " + prefix + "_splittings" )
-                splittings = self.get_masked(prefix + "_splittings")
-                subjets = self.get_masked(prefix + "_subjets")
 
+        if(num_excjets > 0 and self.dtype < 0): 
+            #No gen info
+            if(workers > 1):
+                subjets, subjet_offsets, splittings, split_offsets, _, _ = get_splittings_and_matching_parallel(LP_rw, pf_cands, j_4vec, 
+                        num_excjets = num_excjets, rescale_subjets = rescale_subjets, rescale_vals = rescale_vals, n_pfs = n_pfs, workers = workers)
             else:
-                subjets, splittings, matching, dRs = self.get_matched_splittings(LP_rw, num_excjets, min_evts = min_evts, max_evts =max_evts)
-
-        for i in range(len(pf_cands)):
-
-            split = splittings[i]
-            subjet = subjets[i]
-
-            if(sys_str == 'bquark'):
-                deltaR_cut = 0.2
-                if(self.dtype == 1): #CASE h5 saves all gen decays with pdg ID
-                    B_ID = 5 
-                    #pick out subjets matched to a b quark
-                    gen_bs = [j for j in range(len(gen_parts[i])) if abs(gen_parts[i,j,3]) == B_ID]
-                    dists = get_subjet_dist(gen_parts[i,gen_bs,1:3], np.array(subjet)[:,1:3])
-                else: #ttbar MC saves in order
-                    b_eta_phi = gen_parts[i,26:28]
-                    dists = get_subjet_dist([b_eta_phi], np.array(subjet)[:,1:3])
+                subjets, subjet_offsets, splittings, split_offsets = LP_rw.get_splittings_batch(pf_cands, num_excjets = num_excjets, 
+                        rescale_subjets = rescale_subjets, rescale_vals = rescale_vals, n_pfs = n_pfs)
+            bad_match = [False] * len(pf_cands)
+            if(flat): return subjets, subjet_offsets, splittings, split_offsets, bad_match, []
+            return split_jagged(subjets, subjet_offsets), split_jagged(splittings, split_offsets), bad_match
+
+        gen_parts_eta_phi_raw, gen_mask = self.get_gen_eta_phi(min_evts, max_evts)
+
+        if(workers > 1):
+            subjets, subjet_offsets, splittings, split_offsets, bad_matches, dRs = get_splittings_and_matching_parallel(LP_rw, pf_cands, j_4vec, 
+                    gen_eta_phi = gen_parts_eta_phi_raw, gen_mask = gen_mask, rescale_subjets = rescale_subjets, rescale_vals = rescale_vals, 
+                    n_pfs = n_pfs, workers = workers)
+        else:
+            subjets, subjet_offsets, splittings, split_offsets, bad_matches, dRs = LP_rw.get_splittings_and_matching_batch(pf_cands, 
+                    gen_parts_eta_phi_raw, j_4vec, rescale_subjets = rescale_subjets, rescale_vals = rescale_vals, n_pfs = n_pfs, gen_mask = gen_mask)
 
-                b_matches = []
+        if(flat): return subjets, subjet_offsets, splittings, split_offsets, bad_matches, dRs
+        return split_jagged(subjets, subjet_offsets), split_jagged(splittings, split_offsets), bad_matches, dRs
 
-                j_closest = np.amin(dists, axis = 0)
-                j_which = np.argmin(dists, axis = 0)
 
-                b_matches = np.unique(j_which[j_closest < deltaR_cut])
+    def get_dijet_inputs(self, min_evts = None, max_evts = None, rescale_subjets = "vec"):
+        """Read (and stack) the inputs needed to recluster and match both AK8 jets of the dijet (CASE) events min_evts:max_evts.
+        Only reads the file (no clustering), so it can be done ahead of time, eg. in a background thread (see prefetch)"""
 
-                #reweight only matched subjets
-                if(len(b_matches) > 0):
-                    b_subjet = [subjet[j] for j in range(len(subjet)) if j in b_matches]
+        jet_kinematics = self.get_masked('jet_kinematics', min_evts, max_evts)
+        gen_parts_eta_phi_raw, gen_mask = self.get_gen_eta_phi(min_evts, max_evts)
+        pf_cands1, n_pfs1 = self.get_pf_cands(1, min_evts, max_evts)
+        pf_cands2, n_pfs2 = self.get_pf_cands(2, min_evts, max_evts)
+        n_evts = len(pf_cands1)
 
-                    #splittings save idx of associated subjet
-                    b_split  = [split[j]  for j in range(len(split)) if split[j][0] in b_matches]
+        #stack both jets (padded to a common number of PF candidates) into one batch
+        pf_cands = np.zeros((2*n_evts, max(pf_cands1.shape[1], pf_cands2.shape[1]), pf_cands1.shape[2]), dtype = np.float64)
+        pf_cands[:n_evts, :pf_cands1.shape[1]] = pf_cands1
+        pf_cands[n_evts:, :pf_cands2.shape[1]] = pf_cands2
+        n_pfs = None
+        if(n_pfs1 is not None and n_pfs2 is not None): n_pfs = np.concatenate([n_pfs1, n_pfs2])
+        del pf_cands1, pf_cands2
 
-                    rw, smeared_rw, pt_smeared_rw  = LP_rw.reweight_lund_plane(h_ratio, 
-                            subjets = b_subjet, splittings = b_split, sys_str = sys_str)
-                else: 
-                    rw = 1.0
+        j_4vec = np.concatenate([jet_kinematics[:,2:6], jet_kinematics[:,6:10]]).astype(np.float64)
+        rescale_vals = np.ones(len(j_4vec))
+        if(rescale_subjets == "jec"):
+            rescale_vals = np.concatenate([self.get_masked("jet%i_JME_vars" % j, min_evts, max_evts)[:, 12] for j in (1,2)])
+        elif(rescale_subjets == "vec"):
+            rescale_vals = j_4vec[:,0]
 
+        return pf_cands, n_pfs, j_4vec, rescale_vals, gen_parts_eta_phi_raw, gen_mask
+
+    def get_matched_splittings_dijet(self, LP_rw, num_excjets = -1, min_evts = None, max_evts = None, rescale_subjets = "vec", workers = 1, flat = False, 
+            inputs = None):
+        """Recluster and match both AK8 jets of dijet (CASE) events in a single pass, loading the inputs of the batch of events only once.
+        Returns the subjets and splittings of the 2N jets (the N leading jets followed by the N subleading jets) and 
+        the matching flag of each event (each badly matched jet counts as a 50% unc. on the event weight)
+        With flat = True, the subjets and splittings are returned as flat arrays + offsets : (subjets, subjet_offsets, splittings, split_offsets, bad_match)
+        inputs (optional) : already read inputs of these events (output of get_dijet_inputs)"""
+
+        if(inputs is None): inputs = self.get_dijet_inputs(min_evts, max_evts, rescale_subjets = rescale_subjets)
+        pf_cands, n_pfs, j_4vec, rescale_vals, gen_parts_eta_phi_raw, gen_mask = inputs
+        n_evts = len(pf_cands) // 2
+
+        gen_mask = np.ones(gen_parts_eta_phi_raw.shape[:2], dtype = bool) if gen_mask is None else gen_mask
+        gen_eta_phi = np.concatenate([gen_parts_eta_phi_raw, gen_parts_eta_phi_raw])
+        gen_mask = np.concatenate([gen_mask, gen_mask])
+        if(workers > 1):
+            subjets, subjet_offsets, splittings, split_offsets, bad_matches, dRs = get_splittings_and_matching_parallel(LP_rw, pf_cands, j_4vec, 
+                    gen_eta_phi = gen_eta_phi, gen_mask = gen_mask, rescale_subjets = rescale_subjets, rescale_vals = rescale_vals, n_pfs = n_pfs, workers = workers)
+        else:
+            subjets, subjet_offsets, splittings, split_offsets, bad_matches, dRs = LP_rw.get_splittings_and_matching_batch(pf_cands, 
+                    gen_eta_phi, j_4vec, rescale_subjets = rescale_subjets, rescale_vals = rescale_vals, n_pfs = n_pfs, gen_mask = gen_mask)
+
+        bad_matches = np.array(bad_matches, dtype = np.float64)
+        bad_match = 0.5 * bad_matches[:n_evts] + 0.5 * bad_matches[n_evts:]
+        if(flat): return subjets, subjet_offsets, splittings, split_offsets, bad_match
+        return split_jagged(subjets, subjet_offsets), split_jagged(splittings, split_offsets), bad_match
+
+
+    def get_flat_splittings(self, LP_rw, num_excjets = 2, min_evts = None, max_evts = None, prefix = "", rescale_subjets = "vec"):
+        """Matched subjets and splittings of the (masked) events min_evts:max_evts as flat arrays + offsets 
+        (subjets, subjet_offsets, splittings, split_offsets), read from the cache if present, otherwise reclustered"""
+        print("Getting splittings")
+        cached = self.read_splittings_cache(LP_rw, prefix, num_excjets = num_excjets, rescale_subjets = rescale_subjets, matched = True, 
+                min_evts = min_evts, max_evts = max_evts)
+        if(cached is not None):
+            print("Found saved " + prefix + "_splittings" )
+            return cached[:4]
+        return self.get_matched_splittings(LP_rw, num_excjets, min_evts = min_evts, max_evts =max_evts, 
+                rescale_subjets = rescale_subjets, flat = True)[:4]
 
-            else:
-                rw, smeared_rw, pt_smeared_rw  = LP_rw.reweight_lund_plane(h_ratio, subjets = subjet, splittings = split,                                        
-                        rand_noise = rand_noise, pt_rand_noise = pt_rand_noise, sys_str = sys_str)
+    def reweight_LP(self, LP_rw, h_ratio, num_excjets = 2, min_evts = None, max_evts =None, prefix = "", 
+            rand_noise = None,  pt_rand_noise = None, sys_str = "", subjets = None, splittings = None, norm = True, rescale_subjets = "vec", 
+            bquarks = None, flat_splittings = None):
+        """Lund plane weights of the (masked) events min_evts:max_evts.
+        The subjets and splittings can be given either as per-jet lists (subjets, splittings) or as flat arrays + offsets 
+        (flat_splittings = (subjets, subjet_offsets, splittings, split_offsets)), otherwise they are read from the cache or reclustered.
+        The weights (and toys) of all jets are computed at once (see LundReweighter.reweight_lund_plane_batch), 
+        for the b quark variation only the subjets matched to a b quark are reweighted"""
+
+        eps = 1e-6
+
+        if(splittings is None and flat_splittings is None):
+            flat_splittings = self.get_flat_splittings(LP_rw, num_excjets, min_evts = min_evts, max_evts = max_evts, prefix = prefix, 
+                    rescale_subjets = rescale_subjets)
+        if(flat_splittings is None): flat_splittings = flatten_jagged(subjets, 4) + flatten_jagged(splittings, 3)
+
+        if('bquark' in sys_str):
+            if(bquarks is None): bquarks = self.get_bquarks_eta_phi(min_evts, max_evts)
+            #pick out subjets matched to a b quark
+            b_subjets = get_quark_matched_subjets(*bquarks, flat_splittings[0], flat_splittings[1])
+            LP_weights = LP_rw.reweight_lund_plane_multi([h_ratio], *flat_splittings, sys_strs = [sys_str], subjet_masks = [b_subjets])[:,0]
+            LP_smeared_weights = pt_smeared_weights = None
+        else:
+            LP_weights, LP_smeared_weights, pt_smeared_weights = LP_rw.reweight_lund_plane_batch(h_ratio, *flat_splittings, 
+                    rand_noise = rand_noise, pt_rand_noise = pt_rand_noise, sys_str = sys_str)
 
-            eps = 1e-6
-            rw = max(rw, eps)
-            LP_weights.append(rw)
-            if(rand_noise is not None):
-                LP_smeared_weights.append(smeared_rw)
-            if(pt_rand_noise is not None):
-                pt_smeared_weights.append(pt_smeared_rw)
+        LP_weights = np.maximum(LP_weights, eps)
+        if(LP_smeared_weights is None): LP_smeared_weights = []
+        if(pt_smeared_weights is None): pt_smeared_weights = []
 
 
         if(norm):
@@ -425,6 +861,132 @@ class Dataset():
             return LP_weights, LP_smeared_weights, pt_smeared_weights
         
 
+    def reweight_LP_dijet(self, LP_rw, h_ratio, num_excjets = -1, min_evts = None, max_evts = None, rand_noise = None, pt_rand_noise = None, 
+            sys_str = "", dijet_splittings = None, rescale_subjets = "vec", workers = 1):
+        """Lund plane weights of dijet (CASE) events, the product of the weights of both AK8 jets. Both jets are reweighted in a single pass.
+        dijet_splittings (optional) : output of get_matched_splittings_dijet (flat or not) for these events (reclustered if not given)
+        Weights are not normalized.
+
+        Returns the per-event weights (and the stat and pt toy weights if rand_noise is given) followed by the matching flag of each event"""
+
+        if(dijet_splittings is None):
+            dijet_splittings = self.get_matched_splittings_dijet(LP_rw, num_excjets, min_evts = min_evts, max_evts = max_evts, 
+                    rescale_subjets = rescale_subjets, workers = workers, flat = True)
+        bad_match = dijet_splittings[-1]
+        n_evts = len(bad_match)
+        subjets = splittings = flat_splittings = None
+        if(len(dijet_splittings) == 5): flat_splittings = dijet_splittings[:4]
+        else: subjets, splittings = dijet_splittings[:2]
+
+        bquarks = None
+        if('bquark' in sys_str):
+            b_vals, b_offsets = self.get_bquarks_eta_phi(min_evts, max_evts)
+            bquarks = concat_jagged([b_vals, b_vals], [b_offsets, b_offsets])
+
+        out = self.reweight_LP(LP_rw, h_ratio, num_excjets = num_excjets, rand_noise = rand_noise, pt_rand_noise = pt_rand_noise, sys_str = sys_str, 
+                subjets = subjets, splittings = splittings, flat_splittings = flat_splittings, norm = False, bquarks = bquarks)
+
+        if(rand_noise is None): out = [out]
+        out = [np.array(w) for w in out]
+        out = [w[:n_evts] * w[n_evts:] for w in out]
+        if(rand_noise is None): return out[0], bad_match
+        return out[0], out[1], out[2], bad_match
+
+
+    def reweight_LP_multi(self, LP_rw, h_ratios, sys_strs = None, num_excjets = 2, min_evts = None, max_evts = None, prefix = "", 
+            norm = True, rescale_subjets = "vec", bquarks = None, flat_splittings = None, deltaR_cut = 0.2):
+        """Nominal Lund plane weights of the (masked) events min_evts:max_evts for several ratios (eg. sys_tot_up, sys_tot_down and 
+        the b/light ratio) in a single pass : the splittings are read (or reclustered) and put in the Lund plane only once
+        (see LundReweighter.reweight_lund_plane_multi). Ratios with 'bquark' in their sys_str only reweight the subjets matched to a b quark.
+        
+        Returns an (N, n_ratios) array of weights (each column normalized as in reweight_LP if norm)"""
+
+        eps = 1e-6
+        if(sys_strs is None): sys_strs = [""] * len(h_ratios)
+        if(flat_splittings is None):
+            flat_splittings = self.get_flat_splittings(LP_rw, num_excjets, min_evts = min_evts, max_evts = max_evts, prefix = prefix, 
+                    rescale_subjets = rescale_subjets)
+
+        subjet_masks = [None] * len(h_ratios)
+        if(any(['bquark' in sys_str for sys_str in sys_strs])):
+            if(bquarks is None): bquarks = self.get_bquarks_eta_phi(min_evts, max_evts)
+            b_subjets = get_quark_matched_subjets(*bquarks, flat_splittings[0], flat_splittings[1], deltaR_cut = deltaR_cut)
+            subjet_masks = [b_subjets if 'bquark' in sys_str else None for sys_str in sys_strs]
+
+        LP_weights = LP_rw.reweight_lund_plane_multi(h_ratios, *flat_splittings, sys_strs = sys_strs, subjet_masks = subjet_masks)
+        LP_weights = np.maximum(LP_weights, eps)
+
+        if(norm):
+            LP_weights = np.clip(LP_weights, 0., LP_rw.max_rw)
+            LP_weights /= np.mean(LP_weights, axis = 0)
+            LP_weights = np.clip(LP_weights, LP_rw.min_rw, LP_rw.max_rw)
+            LP_weights /= np.mean(LP_weights, axis = 0)
+        return LP_weights
+
+    def reweight_LP_dijet_multi(self, LP_rw, h_ratios, sys_strs = None, num_excjets = -1, min_evts = None, max_evts = None, 
+            dijet_splittings = None, rescale_subjets = "vec", workers = 1, bquarks = None):
+        """Lund plane weights of dijet (CASE) events for several ratios in a single pass (see reweight_LP_multi), 
+        the product of the weights of both AK8 jets. Weights are not normalized.
+        bquarks (optional) : already read b quarks of these events (output of get_bquarks_eta_phi)
+
+        Returns an (N, n_ratios) array of weights and the matching flag of each event"""
+
+        if(dijet_splittings is None):
+            dijet_splittings = self.get_matched_splittings_dijet(LP_rw, num_excjets, min_evts = min_evts, max_evts = max_evts, 
+                    rescale_subjets = rescale_subjets, workers = workers, flat = True)
+        bad_match = dijet_splittings[-1]
+        n_evts = len(bad_match)
+        if(len(dijet_splittings) == 5): flat_splittings = dijet_splittings[:4]
+        else: flat_splittings = flatten_jagged(dijet_splittings[0], 4) + flatten_jagged(dijet_splittings[1], 3)
+
+        if(sys_strs is not None and any(['bquark' in sys_str for sys_str in sys_strs])):
+            b_vals, b_offsets = self.get_bquarks_eta_phi(min_evts, max_evts) if bquarks is None else bquarks
+            bquarks = concat_jagged([b_vals, b_vals], [b_offsets, b_offsets])
+
+        LP_weights = self.reweight_LP_multi(LP_rw, h_ratios, sys_strs = sys_strs, num_excjets = num_excjets, flat_splittings = flat_splittings, 
+                norm = False, bquarks = bquarks)
+        return LP_weights[:n_evts] * LP_weights[n_evts:], bad_match
+
+
+def prefetch(load, n, depth = 1):
+    """Yield load(0), ..., load(n-1) in order, while the next depth items are loaded in a background thread 
+    (eg. to read the next batch of events from disk while the current one is processed)"""
+    if(n <= 0): return
+    with concurrent.futures.ThreadPoolExecutor(max_workers = 1) as pool:
+        pending = collections.deque(pool.submit(load, i) for i in range(min(depth + 1, n)))
+        for i in range(n):
+            out = pending.popleft().result()
+            if(i + depth + 1 < n): pending.append(pool.submit(load, i + depth + 1))
+            yield out
+
+
+class AsyncWriter():
+    """Run write functions (eg. add_dset) in order in a background thread. 
+    At most max_pending writes are queued (the oldest is waited for first) and errors are raised in the calling thread"""
+
+    def __init__(self, max_pending = 1):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+        self.pending = collections.deque()
+        self.max_pending = max_pending
+
+    def submit(self, func, *args, **kwargs):
+        while(len(self.pending) >= self.max_pending): self.pending.popleft().result()
+        self.pending.append(self.pool.submit(func, *args, **kwargs))
+
+    def flush(self):
+        while(len(self.pending) > 0): self.pending.popleft().result()
+
+    def close(self):
+        try: self.flush()
+        finally: self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def add_dset(f, key, data):
     if(key in f.keys()):
         prev_size = f[key].shape[0]
@@ -438,6 +1000,104 @@ def add_dset(f, key, data):
         else:
             f.create_dataset(key, data = data)
 
+def chunk_slices(n, chunk_size):
+    return [slice(start, min(start + chunk_size, n)) for start in range(0, n, chunk_size)]
+
+def dset_mean(dset, chunk_size = 50000, scale = None):
+    """Mean (along the first axis) of an h5 dataset, read chunk by chunk. 
+    scale (optional) : dataset whose (N) values multiply each row before averaging"""
+    n = dset.shape[0]
+    tot = 0.
+    for sl in chunk_slices(n, chunk_size):
+        vals = dset[sl]
+        if(scale is not None): vals = vals * scale[sl].reshape((-1,) + (1,) * (len(dset.shape) - 1))
+        tot = tot + np.sum(vals, axis = 0)
+    return tot / n
+
+def normalize_weights_chunked(dset, w_min = 0.1, w_max = 10., chunk_size = 50000, nom = None):
+    """Streaming version of LundReweighter.normalize_weights for an (N) or (N, n_toys) h5 dataset, normalized in place :
+    the means after each clipping step are accumulated in two passes over the data, then the weights are rescaled chunk by chunk.
+    Only chunk_size rows are in memory at once.
+    nom (optional) : (already normalized) nominal weights, the normalized weights are divided by them 
+    (ie saved as multiplicative factors relative to nom)
+    Returns the two normalization factors"""
+
+    n = dset.shape[0]
+    norm1 = 0.
+    for sl in chunk_slices(n, chunk_size):
+        norm1 = norm1 + np.sum(np.clip(dset[sl], 0., w_max), axis = 0)
+    norm1 = norm1 / n
+
+    norm2 = 0.
+    for sl in chunk_slices(n, chunk_size):
+        norm2 = norm2 + np.sum(np.clip(np.clip(dset[sl], 0., w_max) / norm1, w_min, w_max), axis = 0)
+    norm2 = norm2 / n
+
+    for sl in chunk_slices(n, chunk_size):
+        w = np.clip(np.clip(dset[sl], 0., w_max) / norm1, w_min, w_max) / norm2
+        if(nom is not None): w /= nom[sl].reshape((-1,) + (1,) * (len(dset.shape) - 1))
+        dset[sl] = w
+    return norm1, norm2
+
+
+def create_dset(f, key, shape, dtype = np.float64, chunk_rows = 1000, compression = None):
+    """Create an output dataset directly at its final size, to be filled with slice writes (see write_rows) rather than
+    resized for every batch. Chunks span chunk_rows rows (eg. the batch size, so that each batch write covers whole chunks).
+    compression (optional) : 'gzip' or 'lzf' filter (with byte shuffling). Rows can still be appended with add_dset"""
+    if(key in f.keys()): del f[key]
+    shape = tuple(int(n) for n in shape)
+    chunks = (max(1, min(chunk_rows, shape[0])),) + shape[1:]
+    if(not compression): compression = None
+    return f.create_dataset(key, shape = shape, dtype = dtype, chunks = chunks, maxshape = (None,) + shape[1:], 
+            compression = compression, shuffle = compression is not None)
+
+def write_rows(f, key, start, data):
+    """Write data into rows start:start+len(data) of a (preallocated) dataset"""
+    f[key][start:start + len(data)] = data
+
+#compact encodings of the saved Lund weights : toys are stored relative to the nominal weights, sys variations are already relative factors
+LUND_WEIGHT_FORMATS = {"log32" : np.float32, "log16" : np.float16}
+LUND_WEIGHT_ENCODINGS = {"lund_weights_stat_var" : "log_ratio_nom", "lund_weights_pt_var" : "log_ratio_nom", "lund_weights_sys_var" : "log"}
+
+def encode_lund_weights(f_in, f_out, fmt = "log16", compression = "gzip", chunk_size = 50000):
+    """Copy the (normalized) Lund weight datasets of f_in to f_out in a compact format : the stat and pt toys as the log of 
+    their ratio to the nominal weight, the sys variations (multiplicative factors) as their log, stored as float32 ('log32') 
+    or float16 ('log16', ~1e-3 relative precision on the factors) with shuffle + compression. Other datasets are copied as is.
+    The encoding is saved in the attributes of the datasets, read them back with read_lund_weights"""
+    dtype = LUND_WEIGHT_FORMATS[fmt]
+    nom = f_in["lund_weights"]
+    for key in f_in.keys():
+        if(not key.startswith("lund_")): continue
+        dset = f_in[key]
+        enc = LUND_WEIGHT_ENCODINGS.get(key, "")
+        if(enc == "" and len(dset.shape) > 0 and dset.shape[0] <= 1):
+            if(key in f_out.keys()): del f_out[key]
+            f_out.create_dataset(key, data = dset[()])
+            continue
+
+        out = create_dset(f_out, key, dset.shape, dtype = dtype if enc != "" else dset.dtype, chunk_rows = dset.chunks[0] if dset.chunks else 1000, 
+                compression = compression)
+        for sl in chunk_slices(dset.shape[0], chunk_size):
+            vals = dset[sl]
+            if(enc == "log_ratio_nom"): vals = np.log(vals / nom[sl].reshape(-1, 1))
+            elif(enc == "log"): vals = np.log(vals)
+            out[sl] = vals
+        if(enc != ""): 
+            out.attrs['encoding'] = enc
+            if(enc == "log_ratio_nom"): out.attrs['nominal'] = "lund_weights"
+
+def read_lund_weights(f, key, start = None, stop = None):
+    """Read (rows start:stop of) a saved Lund weight dataset, decoding the compact formats of encode_lund_weights 
+    (same values as the float64 format, up to the precision of the encoding)"""
+    dset = f[key]
+    vals = dset[start:stop]
+    enc = dset.attrs.get('encoding', "")
+    if(enc == ""): return vals
+    vals = np.exp(vals.astype(np.float64))
+    if(enc == "log_ratio_nom"): vals *= f[dset.attrs['nominal']][start:stop].reshape(-1, 1)
+    return vals
+
+
 def fit_ratio(data, s_val, b_val):
     w = ROOT.RooWorkspace("w", "w")
     n_obs = ROOT.RooRealVar("n_obs", "", 10, 0, 1000000)